@@ -18,4 +18,34 @@ local function getConfig()
     return config
 end
 
-return {setup = setup, getConfig = getConfig}
+-- applies a render plan of the OutputManager in one go. plan is a list of
+-- entries {ns = <namespace name>, clear = <bool>, del = {<extmark id>, ...},
+-- set = {{row, extmark opts (including the id)}, ...}}
+local function render(bufnr, plan)
+    local lineCount = vim.api.nvim_buf_line_count(bufnr)
+    for _, entry in ipairs(plan) do
+        local ns = vim.api.nvim_create_namespace(entry.ns)
+        if entry.clear then
+            vim.api.nvim_buf_clear_namespace(bufnr, ns, 0, -1)
+        end
+        for _, id in ipairs(entry.del) do
+            vim.api.nvim_buf_del_extmark(bufnr, ns, id)
+        end
+        for _, mark in ipairs(entry.set) do
+            local row, opts = mark[1], mark[2]
+            -- the buffer might have changed in the meantime
+            if row < lineCount then
+                if opts.end_row and opts.end_row >= lineCount then
+                    local last = vim.api.nvim_buf_get_lines(
+                                    bufnr, lineCount - 1, lineCount, true)[1]
+                    opts.end_row, opts.end_col = lineCount - 1, #last
+                end
+                vim.api.nvim_buf_set_extmark(bufnr, ns, row, 0, opts)
+            else
+                vim.api.nvim_buf_del_extmark(bufnr, ns, opts.id)
+            end
+        end
+    end
+end
+
+return {setup = setup, getConfig = getConfig, render = render}
@@ -1,41 +1,239 @@
 from .config import config
+from .nameAnalysis import mutableGlobals, readOnlyNames, sharingNames
+from .warmModules import isStableModule
+from .sharedBuffers import sharedCopy, isReadOnlyError
+from .copyStrategies import copyValue
+from .utils.stdoutStream import StdoutStream
+from .profiler import MemoryProbe
 
 import sys
+import time
 import ast
+import copy
 import logging
-import dill
 import types
-import inspect
 import traceback
 import pprint
-import copy
+import signal
+import threading
+import itertools
 from pathlib import Path
+from contextlib import redirect_stdout, contextmanager
+from collections import OrderedDict
+
+# (filename, col_offset, source) -> code object compiled at line 1
+_codeCache = OrderedDict()
+_codeCacheSize = 1024
+
+def _relocate(code, shift):
+    # all line numbers of a code object (and the nested ones) are relative to
+    # co_firstlineno. The cached ones start at line 1, so shift is >= 0
+    consts = tuple(_relocate(c, shift) if isinstance(c, types.CodeType) else c
+                        for c in code.co_consts)
+    return code.replace(co_firstlineno=code.co_firstlineno + shift,
+                        co_consts=consts)
+
+# identify the states of the namespaces (-> Chunk.stateId)
+_stateIds = itertools.count()
+
+# the values printExpr doesn't need to format right away
+_immutableTypes = {int, float, complex, bool, bytes, range}
+
+class ChunkInterrupted(BaseException):
+    """Raised in the executed code if it exceeded its time budget or got
+    interrupted (SIGINT). It's no Exception, so the code can't swallow it
+    by accident"""
+
+# the time budget of the code that is being executed (None -> no budget) and
+# the message it gets interrupted with, the signals are ignored while no code
+# is executed
+_timersEnabled = False
+_executing = False
+_budget = None
+_timeoutMessage = None
+# > 0 while the main thread runs plugin code on behalf of the executed code
+# (-> _deferInterrupts), the interrupt is raised once it's done
+_pluginDepth = 0
+_deferred = None
+
+def _interrupt(signum, frame):
+    global _deferred
+    if not _executing:
+        return
+    message = 'interrupted' if signum == signal.SIGINT else _timeoutMessage
+    if _pluginDepth:
+        _deferred = message
+        return
+    raise ChunkInterrupted(message)
+
+@contextmanager
+def _deferInterrupts():
+    # the plugin code must not be interrupted half way, it might be in the
+    # middle of sending a message (the signals are handled by the main thread
+    # only)
+    global _pluginDepth, _deferred
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    _pluginDepth += 1
+    try:
+        yield
+    finally:
+        _pluginDepth -= 1
+        if not _pluginDepth and _deferred and _executing:
+            message, _deferred = _deferred, None
+            raise ChunkInterrupted(message)
+
+def enableInterrupts():
+    """Installs the handlers for SIGINT and SIGALRM (time budgets, not
+    available on windows). Needs to be called from the main thread"""
+    global _timersEnabled
+    signal.signal(signal.SIGINT, _interrupt)
+    if hasattr(signal, 'setitimer'):
+        signal.signal(signal.SIGALRM, _interrupt)
+        _timersEnabled = True
+
+def _arm(budget):
+    # budget: (seconds, message) or None
+    global _executing, _budget, _timeoutMessage
+    _budget, _timeoutMessage = budget or (None, None)
+    _executing = True
+    if _budget and _timersEnabled:
+        signal.setitimer(signal.ITIMER_REAL, _budget)
+
+def _disarm():
+    global _executing, _deferred
+    # the flag first, a pending signal is ignored this way
+    _executing = False
+    _deferred = None
+    if _budget and _timersEnabled:
+        signal.setitimer(signal.ITIMER_REAL, 0)
 
 class GlobalsWrapper(dict):
     def __init__(self):
         super().__init__()
         self.data = None
+        self.written = set()
 
     def setData(self, data):
         self.data = data
+        self.written = set()
 
     def __getitem__(self, key):
         assert self.data
-        return self.data.__getitem__(key)
+        try:
+            return self.data.__getitem__(key)
+        except KeyError:
+            # exec stores __builtins__ in the wrapper itself, c code
+            # (PyImport_Import,...) looks it up via the mapping protocol
+            return super().__getitem__(key)
 
     def __setitem__(self, key, value):
         assert self.data
+        self.written.add(key)
         return self.data.__setitem__(key, value)
 
+def executeCode(codeObject, namespace, globalState, filename, firstLine,
+                lastLine, budget=None, onOutput=None, shared=()):
+    """Executes codeObject with globalState as globals (which is namespace or
+    wraps it) and returns its stdout, vtexts and whether it succeeded
+
+    The execution gets interrupted after budget = (seconds, message)
+    (-> enableInterrupts), the new lines of stdout are passed to onOutput
+    while it's running (-> StdoutStream). shared are the names of the buffers that are passed as
+    read-only views (-> sharedCopy).
+    """
+
+    # inject locally wrapped print and printExpr functions. The line of an
+    # expression is passed relative to the first line of the chunk
+    # (-> ExprPrintWrapper), only the ones in function bodies need to look at
+    # the frame. Only config.maxExprOutputs outputs are kept per line,
+    # formatting immutable values is deferred till the end
+    printOutputs = {}
+    omitted = {}
+    maxOutputs = config.maxExprOutputs
+    def printExprWrapper(x, offset):
+        if x is None:
+            return
+        if offset is None:
+            lno = sys._getframe(1).f_lineno
+        else:
+            lno = firstLine + offset
+        outputs = printOutputs.setdefault(lno, [])
+        if len(outputs) >= maxOutputs:
+            omitted[lno] = omitted.get(lno, 0) + 1
+        elif type(x) in _immutableTypes:
+            outputs.append(x)
+        else:
+            outputs.append(pprint.pformat(x))
+
+    namespace['printExpr'] = printExprWrapper
+
+    # and execute the chunk and capture stdout
+    def flushOutput(*output):
+        with _deferInterrupts():
+            onOutput(*output)
+
+    stdoutBuffer = StdoutStream(config.maxStdoutLines,
+                                flushOutput if onOutput else None,
+                                config.stdoutFlushInterval)
+    with redirect_stdout(stdoutBuffer):
+        error = None
+        try:
+            _arm(budget)
+            try:
+                exec(codeObject, globalState)
+            finally:
+                _disarm()
+        except ChunkInterrupted as e:
+            _disarm()
+            # the line of the chunk that was running
+            frames = [f for f in traceback.extract_tb(e.__traceback__)
+                        if Path(f.filename).absolute() ==
+                           Path(filename).absolute()]
+            error = (frames[-1].lineno if frames else lastLine, str(e))
+        except Exception as e:
+            _, _, tb = sys.exc_info()
+            tb = traceback.extract_tb(tb)[-1]
+            if Path(tb.filename).absolute() == Path(filename).absolute():
+                ln = tb[1]
+            else:
+                ln = lastLine
+            error = (ln, traceback.format_exc())
+            if shared and isReadOnlyError(e):
+                error = (ln, error[1] + f'buffer is shared read-only: '
+                                        f'{", ".join(sorted(shared))} '
+                                        f'(-> shareBuffers)')
+
+    stdoutBuffer.finish()
+    stdout = stdoutBuffer.getvalue()
+    vtexts = {lno: [t if isinstance(t, str) else pprint.pformat(t)
+                        for t in outputs]
+                    for lno, outputs in printOutputs.items()}
+    for lno, n in omitted.items():
+        vtexts[lno].append(f'... ({n} more)')
+    if error:
+        stdout += '\n' + error[1]
+        vtexts[error[0]] = vtexts.get(error[0], [])
+        vtexts[error[0]].append(error[1])
+
+    del namespace['printExpr']
+
+    return stdout, vtexts, error == None
+
 class Chunk(object):
     def __init__(self, node, sourceChunk, filename, prevChunk,
-                 outputManager=None):
+                 outputManager=None, writes=None, chash=None):
 
+        self.chash = chash
         self.sourceChunk = sourceChunk
         self.prevChunk = prevChunk
         self.outputManager = outputManager
         self.filename = filename
         self.node = node
+        # the nodes of moved chunks get moved in place (-> ChunkManager)
+        self.lineno = node.lineno if node else None
         self.codeObject = None
 
         # all chunks -- of the same "execution chain" / ChunkManager -- share
@@ -44,16 +242,52 @@ class Chunk(object):
         # with all other chunks
         self.globalState = prevChunk.globalState if prevChunk \
                                                  else GlobalsWrapper()
+        # ... the same goes for the CheckpointEngine and the SnapshotStore
+        # (if any)
+        self.checkpoints = prevChunk.checkpoints if prevChunk else None
+        self.snapshots = prevChunk.snapshots if prevChunk else None
         self.namespace = None
 
-        # defines valid, stdout and vtexts
+        # the names this chunk (re)bound or mutated (delta) and deleted. Its
+        # namespace is the namespace of prevChunk updated by those, this
+        # allows to rebase the chunk onto a new prevChunk. writes are the
+        # names the chunk might mutate (None -> unknown)
+        self.writes = writes
+        self.delta, self.deleted = {}, set()
+        # the names the last execution mutated through other names (their
+        # values share objects with the changed ones)
+        self.aliasWrites = set()
+
+        # stateId changes whenever the namespace is derived from a different
+        # state, baseState is the stateId of prevChunk it was derived from.
+        # The namespace itself might have been evicted (-> SnapshotStore)
+        self.stateId = None
+        self.baseState = None
+
+        # defines valid, stdout, vtexts and stats
         self.reset()
 
-    def reset(self):
+    def reset(self, render=True):
         self._valid, self.stdout, self.vtexts = False, None, {}
-        if self.outputManager:
+        # the costs of the last execution (-> profiler): wall, cpu, copy and
+        # compile time (in seconds), size and peak memory (in bytes) and
+        # copyTypes: type -> (number of copies, copy time)
+        self.stats = {}
+        if self.checkpoints:
+            self.checkpoints.drop(self)
+        if self.snapshots:
+            self.snapshots.forget(self)
+        if self.outputManager and render:
             self.outputManager.update(self)
 
+    def skip(self, reason):
+        # the chunk is not executed, reason is shown as its error
+        self.reset(render=False)
+        self.stdout = reason
+        self.vtexts = {self.lineRange.start: [reason]}
+        assert self.outputManager
+        self.outputManager.update(self)
+
     @property
     def valid(self):
         return self._valid
@@ -63,52 +297,210 @@ class Chunk(object):
         assert self.node
         return range(self.node.lineno, self.node.end_lineno + 1)
 
-    def update(self, node):
+    def update(self, node, prevChunk):
+        # keep the vtexts at their lines if the chunk moved
+        shift = node.lineno - self.lineno
+        if shift:
+            self.vtexts = {lno + shift: t for lno, t in self.vtexts.items()}
+
         self.node = node
+        self.lineno = node.lineno
+        self.prevChunk = prevChunk
+
+    def rebase(self):
+        # the chunk is still valid, but prevChunk got (re)executed or
+        # exchanged -> apply our delta to the new namespace of prevChunk.
+        # Returns False if the state of prevChunk could not be rebuilt, the
+        # chunk is invalid in that case
+        assert self._valid and self.prevChunk._valid
+
+        if self.baseState == self.prevChunk.stateId:
+            return True
+        self.stateId, self.baseState = next(_stateIds), self.prevChunk.stateId
+
+        if self.checkpoints:
+            # the checkpoint was derived from the old prevChunk, it will get
+            # replayed from the new one when needed
+            self.checkpoints.drop(self)
+            self.namespace = {}
+            return True
+
+        if self.snapshots:
+            if self.snapshots.evicted(self):
+                # it gets derived from the new prevChunk when it's needed
+                return True
+            if not self.snapshots.materialize(self.prevChunk):
+                self.reset()
+                return False
+
+        self.deriveNamespace()
+        if self.snapshots:
+            self.snapshots.track(self)
+        return True
+
+    def deriveNamespace(self):
+        self.namespace = dict(self.prevChunk.namespace)
+        self.namespace.update(self.delta)
+        for k in self.deleted:
+            self.namespace.pop(k, None)
+
+    def restore(self, delta, deleted, stdout, vtexts):
+        # restore the results of a previous execution (-> DiskCache), the
+        # namespace gets derived from prevChunk when needed (-> rebase)
+        self.delta, self.deleted = delta, deleted
+        self.stdout, self.vtexts = stdout, vtexts
+        self.namespace, self.stateId, self.baseState = None, None, None
+        if self.snapshots:
+            self.snapshots.forget(self)
+        self._valid = True
+
+        assert self.outputManager
+        self.outputManager.update(self)
 
     def cleanup(self):
+        if self.checkpoints:
+            self.checkpoints.drop(self)
+        if self.snapshots:
+            self.snapshots.forget(self)
         assert self.outputManager
         self.outputManager.delete(self)
 
-    def execute(self):
+    def compile(self):
+        # the code objects are cached by source (compiled at line 1), chunks
+        # that just moved get the line numbers of the cached one relocated
+        # instead of compiling them again
+        if not config.reuseCodeObjects:
+            wrapperModule = ast.Module(body=[self.node], type_ignores=[])
+            self.codeObject = compile(wrapperModule, self.filename, 'exec')
+            return self.codeObject
+
+        lineno = self.node.lineno
+        key = (self.filename, self.node.col_offset, self.sourceChunk)
+        code = _codeCache.get(key)
+
+        if code is None:
+            node = copy.deepcopy(self.node)
+            ast.increment_lineno(node, 1 - lineno)
+            wrapperModule = ast.Module(body=[node], type_ignores=[])
+            code = compile(wrapperModule, self.filename, 'exec')
+            _codeCache[key] = code
+            if len(_codeCache) > _codeCacheSize:
+                _codeCache.popitem(last=False)
+        else:
+            _codeCache.move_to_end(key)
+
+        try:
+            self.codeObject = _relocate(code, lineno - 1)
+        except ValueError:
+            logging.debug('relocating %s failed', self.getDebugId())
+            _codeCache.pop(key, None)
+            wrapperModule = ast.Module(body=[self.node], type_ignores=[])
+            self.codeObject = compile(wrapperModule, self.filename, 'exec')
+        return self.codeObject
+
+    def execute(self, budget=None):
+        # budget: the max time (in seconds) the chunk may run and the message
+        # it gets interrupted with (-> ChunkManager._budget)
         logging.debug('exec %s', self.getDebugId())
 
         assert self.prevChunk
         assert self.prevChunk._valid
 
-        # compile code if it's the first time we execute this chunk'
-        if not self.codeObject or not config.reuseCodeObjects:
-            wrapperModule = ast.Module(body=[self.node], type_ignores=[])
-            self.codeObject = compile(wrapperModule, self.filename, 'exec')
-
-        # store the sys.modules before we execute this chunk
-        beforeModules = set([m for m in sys.modules.keys()])
+        if self.snapshots and not self.snapshots.materialize(self.prevChunk):
+            # the state of prevChunk is gone
+            self.reset()
+            return False
+
+        start = time.perf_counter()
+        cpu = time.process_time()
+        self.stats = {'start': start}
+        self.compile()
+        self.stats['compile'] = time.perf_counter() - start
+
+        # stream stdout while the chunk is running (if the outputManager
+        # supports it)
+        stream = getattr(self.outputManager, 'streamStdout', None)
+        onOutput = (lambda lines, partial: stream(self, lines, partial)) \
+                        if stream else None
+
+        if self.checkpoints:
+            # the namespace lives in the checkpoint processes, a new
+            # (empty) namespace object marks the new state. The checkpoint
+            # measures the cpu time and memory
+            self.stdout, self.vtexts, self._valid = \
+                    self.checkpoints.execute(self, budget, onOutput)
+            self.namespace = {}
+        else:
+            probe = MemoryProbe()
+            self._executeInProcess(budget, onOutput)
+            self.stats['cpu'] = time.process_time() - cpu
+            self.stats.update(probe.result(self.delta))
+        self.stateId, self.baseState = next(_stateIds), self.prevChunk.stateId
+
+        self.stats['wall'] = time.perf_counter() - start
 
-        # derive namespace from prevChunk, based on a dill copy
-        self.namespace = {}
+        assert self.outputManager
+        self.outputManager.update(self)
 
-        # copy functions and classes by reference! Otherwise their __globals__
-        # field gets invalid
-        for k, v in self.prevChunk.namespace.items():
-            if isinstance(v, types.FunctionType) or isinstance(v, type):
-                self.namespace[k] = v
-            elif isinstance(v, types.ModuleType):
-                self.namespace[k] = dill.copy(v)
+        if self.snapshots:
+            if self._valid:
+                self.snapshots.add(self)
             else:
-                self.namespace[k] = copy.deepcopy(v)
+                self.snapshots.forget(self)
+
+        return self._valid
+
+    def replay(self):
+        # rebuilds the dropped snapshot (-> SnapshotStore) by executing the
+        # chunk again, its outputs stay as they are
+        outputs = self.stdout, self.vtexts, self.stats
+        self.compile()
+        self._executeInProcess(None, None)
+        if not self._valid:
+            self.reset()
+            return False
 
-        # inject locally wrapped print and printExpr functions
-        printOutputs = {}
-        def printExprWrapper(x):
-            if x == None:
-                return
-            caller = inspect.getframeinfo(inspect.stack()[1][0])
-            if not isinstance(x, str):
-                x = pprint.pformat(x)
-            printOutputs[caller.lineno] = printOutputs.get(caller.lineno, [])
-            printOutputs[caller.lineno].append(x)
+        self.stdout, self.vtexts, self.stats = outputs
+        return True
 
-        self.namespace['printExpr'] = printExprWrapper
+    def _executeInProcess(self, budget, onOutput):
+        # store the sys.modules before we execute this chunk
+        beforeModules = set([m for m in sys.modules.keys()])
+
+        # derive namespace from prevChunk. Everything this chunk can't reach
+        # is shared by reference (copy on write), only the values it might
+        # mutate get copied
+        start = time.perf_counter()
+        prevNamespace = self.prevChunk.namespace
+        self.namespace = dict(prevNamespace)
+        mutable = mutableGlobals(self.node, prevNamespace, self.globalState)
+
+        # buffers the chunk only reads are shared with prevChunk, the ones it
+        # might write (assignments, method calls, arguments of calls,...
+        # -> Dataflow) get copied
+        shareable = set()
+        if config.shareBuffers and self.writes is not None:
+            shareable = (mutable & readOnlyNames(self.node)) - self.writes
+        shared = set()
+
+        # the copy time per type (-> copyValue) goes into the stats. The
+        # values reachable through several names stay shared (memo)
+        copyTypes = {}
+        memo = {}
+        for k in mutable:
+            v = prevNamespace[k]
+            view = sharedCopy(v) if k in shareable else None
+            if view is not None:
+                self.namespace[k] = view
+                shared.add(k)
+                continue
+
+            t = time.perf_counter()
+            self.namespace[k], name = copyValue(v, memo)
+            count, total = copyTypes.get(name, (0, 0))
+            copyTypes[name] = (count + 1, total + time.perf_counter() - t)
+        self.stats['copy'] = time.perf_counter() - start
+        self.stats['copyTypes'] = copyTypes
 
         # set our local namespace as "global namespace". This needs to be
         # wrapped, because all function objects contain a reference to the
@@ -117,28 +509,30 @@ class Chunk(object):
         # wrapper to exchange the global namespace under the hood
         self.globalState.setData(self.namespace)
 
-        # and execute the chunk and capture stdout
-        with dill.temp.capture() as stdoutBuffer:
-            error = None
-            try:
-                exec(self.codeObject, self.globalState)
-            except Exception:
-                _, _, tb = sys.exc_info()
-                tb = traceback.extract_tb(tb)[-1]
-                if Path(tb.filename).absolute() == Path(self.filename).absolute():
-                    ln = tb[1]
-                else:
-                    ln = self.lineRange.stop - 1
-                error = (ln, traceback.format_exc())
-
-        self.stdout = stdoutBuffer.getvalue()
-        self.vtexts = dict(printOutputs)
-        if error:
-            self.stdout += '\n' + error[1]
-            self.vtexts[error[0]] = self.vtexts.get(error[0], [])
-            self.vtexts[error[0]].append(error[1])
-
-        del self.namespace['printExpr']
+        self.stdout, self.vtexts, self._valid = \
+                executeCode(self.codeObject, self.namespace, self.globalState,
+                            self.filename, self.lineRange.start,
+                            self.lineRange.stop - 1, budget, onOutput,
+                            shared)
+
+        # the copies of names that are only read are not part of the delta
+        written = self.globalState.written
+        mutated = mutable if self.writes is None else mutable & self.writes
+        self.delta = {k: v for k, v in self.namespace.items()
+                           if k not in prevNamespace or k in written or
+                              (k in mutated and prevNamespace[k] is not v)}
+        self.deleted = set(prevNamespace.keys()) - set(self.namespace.keys())
+
+        # the copies that share objects with the changed values changed as
+        # well (o.x = b; o.x.append(1) -> b), they go into the delta so they
+        # stay together when the chunk gets rebased
+        copied = {k for k in mutable - shared - self.delta.keys()
+                    if k in self.namespace}
+        self.aliasWrites = set()
+        if copied and self.delta:
+            self.aliasWrites = sharingNames(self.delta.keys(), copied,
+                                            self.namespace)
+            self.delta.update((k, self.namespace[k]) for k in self.aliasWrites)
 
         # unload modules that are not imported in the outside world
         # (outside of the exec envinronment) this is necessary to
@@ -148,23 +542,22 @@ class Chunk(object):
         # in the outside world (outside the exec environment).....
         # I did not found a solution to save and restore the state of sys
         # for example... :(
+        # Stable modules (-> isStableModule) stay loaded, importing them again
+        # is way too expensive
         afterModules = set([m for m in sys.modules.keys()])
         for m in (afterModules - beforeModules):
-            del sys.modules[m]
-
-        self._valid = error == None
-
-        assert self.outputManager
-        self.outputManager.update(self)
-
-        return self._valid
+            if not isStableModule(m, sys.modules[m]):
+                del sys.modules[m]
 
     def getDebugId(self):
         return f'{self.lineRange.start}: {self.sourceChunk.splitlines()[0]}'
 
 class DummyInitialChunk(Chunk):
-    def __init__(self, initialNamespace):
+    def __init__(self, initialNamespace, checkpoints=None, snapshots=None):
         super().__init__(None, None, None, None)
         self.namespace = initialNamespace
+        self.checkpoints = checkpoints
+        self.snapshots = snapshots
+        self.stateId = next(_stateIds)
         self._valid = True
 
@@ -1,95 +1,279 @@
+import re
 import ast
+import time
 import logging
+from bisect import bisect_right
 
 from .chunk import Chunk, DummyInitialChunk
+from .nameAnalysis import Dataflow, NodeInfo
+from .diskCache import DiskCache, stableHash
+from .profiler import TraceLog
+from .snapshotStore import SnapshotStore
+from .config import config
 
 
 class ExprPrintWrapper(ast.NodeTransformer):
-    """Wraps all Expr-Statements in a call to print()"""
+    """Wraps all Expr-Statements in a call to printExpr(value, offset)
+
+    offset is the line of the expression relative to the first line of its
+    top level statement, this way moved chunks don't need to be transformed
+    again. Function bodies might be executed by any later chunk, their
+    offset is None (-> the line gets looked up when they are called).
+    """
+    def visit_Module(self, node):
+        self.inFunction = 0
+        body = []
+        for n in node.body:
+            self.firstLine = n.lineno
+            body.append(self.visit(n))
+        node.body = body
+        return node
+
+    def _visitFunction(self, node):
+        self.inFunction += 1
+        self.generic_visit(node)
+        self.inFunction -= 1
+        return node
+
+    visit_FunctionDef = _visitFunction
+    visit_AsyncFunctionDef = _visitFunction
+
     def visit_Expr(self, node):
+        offset = None if self.inFunction else node.lineno - self.firstLine
         new = ast.Expr(
                 value = ast.Call(
                     func = ast.Name(id='printExpr', ctx=ast.Load()),
-                    args = [node.value], keywords = [])
+                    args = [node.value, ast.Constant(value=offset)],
+                    keywords = [])
                 )
         ast.copy_location(new, node)
         ast.fix_missing_locations(new)
         return new
 
 
+def _firstLine(node):
+    # the (1 based) first line of a statement including its decorators
+    return min([node.lineno] + [d.lineno for d in
+                                getattr(node, 'decorator_list', [])])
+
+# top level lines that continue the statement before them
+_continuation = re.compile(r'(else|elif|except|finally)\b')
+
+def _parsePrefix(lines, e):
+    # parses the top level statements before the broken one (-> e), returns
+    # the module and the (0 based) line it stops at
+    last = min(e.lineno or len(lines), len(lines))
+    for stop in range(last - 1, 0, -1):
+        line = lines[stop]
+        if not line or line[0] in ' \t#' or _continuation.match(line):
+            continue
+        try:
+            return ast.parse('\n'.join(lines[:stop])), stop
+        except SyntaxError:
+            pass
+    return ast.parse(''), 0
+
+def _sourceSegment(lines, node):
+    # ast.get_source_segment without splitting the whole source again (the
+    # col offsets are utf8 byte offsets). Including the decorators, otherwise
+    # differently decorated functions would have the same source
+    start = _firstLine(node)
+    colOffset = node.col_offset if start == node.lineno else 0
+    segment = lines[start-1:node.end_lineno]
+    if len(segment) == 1:
+        return segment[0].encode()[colOffset:node.end_col_offset].decode()
+    first = segment[0].encode()[colOffset:].decode()
+    last = segment[-1].encode()[:node.end_col_offset].decode()
+    return '\n'.join([first] + segment[1:-1] + [last])
+
+
 class ChunkManager(object):
-    def __init__(self, outputManager):
+    def __init__(self, outputManager, checkpoints=None):
         self.chunkList = []
         self.chunks = {}
+        # the first lines of the chunks in chunkList (-> _getChunkByLine)
+        self.chunkStarts = []
+        # returns True if the current run should stop (checked before each
+        # chunk gets executed)
+        self.cancelCheck = None
+        # when the time budget of the current run (config.runTimeout) is used
+        self.runDeadline = None
+        # the executions of the chunks (-> exportTrace)
+        self.trace = TraceLog()
         self.outputManager = outputManager
 
+        # the fork engine keeps its snapshots in the checkpoint processes
+        self.snapshots = None
+        if config.snapshotMemory and not checkpoints:
+            self.snapshots = SnapshotStore()
+        self.initialChunk = DummyInitialChunk({}, checkpoints, self.snapshots)
+
+        # the fork engine has no namespaces that could be cached
+        self.diskCache = None
+        if config.diskCache and not checkpoints:
+            self.diskCache = DiskCache()
+
+        # the statements of the last successful parse and the NodeInfos of
+        # their sources, they are reused by the next (incremental) update
+        self.body = None
+        self.nodeInfos = {}
+        # the number of lines before a syntax error (None -> no error)
+        self.parsedLines = None
+
         self.isRunable = False
 
-    def _parseSource(self, source):
+    def _parseSource(self, lines, dirty=None):
+        body = None
+        if dirty and self.body is not None:
+            body = self._reparse(lines, dirty)
+
+        error = None
+        if body is None:
+            try:
+                module_ast = ast.parse('\n'.join(lines))
+            except SyntaxError as e:
+                # the statements before the broken one stay runnable, the
+                # lines from there on are marked as syntax error
+                error = e
+                module_ast, stop = _parsePrefix(lines, e)
+
+            # wrap every expression statement into a print call
+            body = ExprPrintWrapper().visit(module_ast).body
+
+        if error:
+            self.outputManager.setSyntaxError(error,
+                                              range(stop + 1, len(lines) + 1))
+        else:
+            self.outputManager.setSyntaxError(None)
+        self.isRunable = True
+        self.parsedLines = stop if error else None
+        # the prefix can't be reparsed incrementally, it doesn't cover the
+        # source
+        self.body = None if error else body
+        return body
+
+    def _reparse(self, lines, dirty):
+        # dirty = (start, oldEnd, newEnd): the (0 based, end exclusive) lines
+        # that changed since the last parse. Only the statements touching it
+        # -- and their neighbours, an edit might merge / split statements --
+        # get parsed again, the following ones just get moved
+        start, oldEnd, newEnd = dirty
+        body = self.body
+        if not body:
+            return None
+
+        i = next((k for k, n in enumerate(body) if n.end_lineno > start),
+                 len(body))
+        i = max(i - 1, 0)
+        j = next((k for k, n in enumerate(body)
+                        if k >= i and _firstLine(n) - 1 >= oldEnd), len(body))
+        j = min(j + 1, len(body))
+
+        # statements sharing a line (a = 1; b = 2) can't be separated
+        while i > 0 and body[i-1].end_lineno >= _firstLine(body[i]):
+            i -= 1
+        while j < len(body) and _firstLine(body[j]) <= body[j-1].end_lineno:
+            j += 1
+
+        first = _firstLine(body[i]) - 1 if i else 0
+        delta = newEnd - oldEnd
+        last = _firstLine(body[j]) - 1 + delta if j < len(body) \
+                                               else len(lines)
+
         try:
-            module_ast = ast.parse(source)
-        except SyntaxError as e:
-            self.isRunable = False
-            self.outputManager.setSyntaxError(e)
+            region = ast.parse('\n'.join(lines[first:last]))
+        except SyntaxError:
+            # let the full parse report the error
             return None
 
-        self.outputManager.setSyntaxError(None)
-        self.isRunable = True
+        ast.increment_lineno(region, first)
+        region = ExprPrintWrapper().visit(region)
 
-        # wrap every expression statement into a print call
-        return ExprPrintWrapper().visit(module_ast)
+        # the moved statements are shared with their chunks
+        tail = body[j:]
+        if delta:
+            for n in tail:
+                ast.increment_lineno(n, delta)
 
+        return body[:i] + region.body + tail
 
-    def update(self, source, filename='<string>'):
+    def update(self, source, filename='<string>', dirty=None):
         changed = False
 
-        module_ast = self._parseSource(source)
-        if not module_ast:
+        lines = source.split('\n')
+        body = self._parseSource(lines, dirty)
+        if body is None:
             return False
 
         #reset chunkList
         self.chunkList = []
-        prevChunk = DummyInitialChunk({})
-        prevChash = 0
-
-        for n in module_ast.body:
-            # calculate chunk hash
-            sourceChunk = ast.get_source_segment(source, n)
-            chash = f'{prevChash}{sourceChunk}'.__hash__()
+        prevChunk = self.initialChunk
+        dataflow = Dataflow()
+        occurrences = {}
+        nodeInfos = {}
+
+        for n in body:
+            # calculate chunk hash. It depends on the source of the chunk and
+            # the hashes of the chunks it depends on. This way only the chunks
+            # that (transitively) depend on a changed chunk get invalidated
+            sourceChunk = _sourceSegment(lines, n)
+            info = self.nodeInfos.get(sourceChunk) or NodeInfo(n)
+            nodeInfos[sourceChunk] = info
+
+            deps = sorted(self.chunkList[i] for i in dataflow.add(n, info))
+            chash = stableHash(sourceChunk, *deps)
+
+            # identical chunks with identical dependencies
+            occurrences[chash] = occurrences.get(chash, -1) + 1
+            if occurrences[chash]:
+                chash = stableHash(chash, str(occurrences[chash]))
 
             self.chunkList.append(chash)
 
             # update chunk or create new one
             if chash in self.chunks:
-                # chunk (and it predecessors) did not change
-                # there might have been a whitespace change
+                # chunk (and its dependencies) did not change
+                # there might have been a whitespace change or a change
+                # of an unrelated chunk
                 chunk = self.chunks[chash]
-                chunk.update(n)
+                chunk.update(n, prevChunk)
+                # the names it mutated through aliases (-> Chunk.aliasWrites)
+                dataflow.addWrites(chunk.aliasWrites)
             else:
-                # chunk or a predecessor changed
+                # chunk or a dependency changed
                 # create new chunk
                 chunk = Chunk(n, sourceChunk, filename, prevChunk,
-                              self.outputManager)
+                              self.outputManager, dataflow.writes[-1], chash)
                 self.chunks[chash] = chunk
                 changed = True
 
+                if self.diskCache:
+                    self.diskCache.restore(chash, chunk)
+
                 logging.debug('changed %s', self.chunks[chash].getDebugId())
 
             prevChunk = chunk
-            prevChash = chash
 
+        self.nodeInfos = nodeInfos
+        self.chunkStarts = [self.chunks[chash].lineRange.start
+                                for chash in self.chunkList]
         return self._cleanUpCache() or changed
 
     def executeAllChunks(self):
         if not self.isRunable:
             return False
+        self._startRun()
+        # the chunks get rendered when they are executed, most of them will
+        # look the same afterwards
         orderedChunks = self._getOrderedChunks()
         for chunk in orderedChunks:
             if chunk.valid:
-                chunk.reset()
+                chunk.reset(render=False)
 
-        for chunk in self._getOrderedChunks():
-            if not chunk.execute():
+        for i, chunk in enumerate(orderedChunks):
+            if not self._execute(chunk):
+                for c in orderedChunks[i+1:]:
+                    self.outputManager.update(c)
                 return False
 
         return True
@@ -97,24 +281,32 @@ class ChunkManager(object):
     def executeAllInvalidChunks(self):
         if not self.isRunable:
             return False
+        self._startRun()
         for chunk in self._getOrderedChunks():
-            if not chunk.valid:
-                if not chunk.execute():
+            if chunk.valid:
+                if not chunk.rebase():
                     return False
+            elif not self._execute(chunk):
+                return False
         return True
 
     def executeFirstInvalidChunk(self):
         if not self.isRunable:
             return False
+        self._startRun()
         for chunk in self._getOrderedChunks():
-            if not chunk.valid:
-                return chunk.execute()
+            if chunk.valid:
+                if not chunk.rebase():
+                    return False
+            else:
+                return self._execute(chunk)
 
         return False
 
     def executeRange(self, selectedRange):
         if not self.isRunable:
             return False
+        self._startRun()
 
         # find first chunk that overlapps with range and set all following
         # chukns invalid
@@ -138,33 +330,78 @@ class ChunkManager(object):
             else:
                 return False
 
-        while not first.prevChunk.valid:
-            first = first.prevChunk
-
-        # run all chunks until the first chunk after selectedRange
+        # run all chunks until the first chunk after selectedRange, starting
+        # with the first invalid chunk, valid chunks in between just need to
+        # be rebased
         idx = orderedChunks.index(first)
-        for chunk in orderedChunks[idx:]:
-            if chunk.lineRange.start > selectedRange.stop-1:
+        for i, chunk in enumerate(orderedChunks):
+            if i >= idx and chunk.lineRange.start > selectedRange.stop-1:
                 break
-            if not chunk.execute():
+            if chunk.valid:
+                if not chunk.rebase():
+                    return False
+            elif not self._execute(chunk):
                 return False
 
         return True
 
+    def _startRun(self):
+        self.trace.startRun()
+        self.runDeadline = None
+        if config.runTimeout:
+            self.runDeadline = time.monotonic() + config.runTimeout
+
+    def _budget(self):
+        # the time budget of the next chunk (-> Chunk.execute)
+        budgets = []
+        if config.chunkTimeout:
+            budgets.append((config.chunkTimeout,
+                            f'timed out after {config.chunkTimeout:g}s'))
+        if self.runDeadline:
+            budgets.append((self.runDeadline - time.monotonic(),
+                            f'run timed out after {config.runTimeout:g}s'))
+        return min(budgets, default=None)
+
+    def _execute(self, chunk):
+        if self.cancelCheck and self.cancelCheck():
+            logging.debug('cancelled before %s', chunk.getDebugId())
+            # it might have been reset silently (-> executeAllChunks)
+            self.outputManager.update(chunk)
+            return False
+
+        budget = self._budget()
+        if budget is not None and budget[0] <= 0:
+            # the run used up its time budget, the chunk is not started
+            chunk.skip(budget[1])
+            return False
+
+        valid = chunk.execute(budget)
+        self.trace.addChunk(chunk.getDebugId(), chunk.stats)
+        if valid and self.diskCache:
+            self.diskCache.store(chunk.chash, chunk)
+        return valid
+
     def _getOrderedChunks(self):
         return [self.chunks[chash] for chash in self.chunkList]
 
     def _getChunkByLine(self, line):
-        for chunk in self.chunks.values():
-            if line in chunk.lineRange:
-                return chunk
-        return None
+        i = bisect_right(self.chunkStarts, line) - 1
+        if i < 0:
+            return None
+        chunk = self.chunks[self.chunkList[i]]
+        return chunk if line in chunk.lineRange else None
 
     def _cleanUpCache(self):
         changed = False
         chunksSet = set(self.chunks.keys())
         listSet = set(self.chunkList)
         for chash in chunksSet - listSet:
+            # the chunks after a syntax error are kept, they are most likely
+            # reused once it's fixed
+            if self.parsedLines is not None and \
+               self.chunks[chash].lineRange.start > self.parsedLines:
+                continue
+
             logging.debug("deleted %s", self.chunks[chash].getDebugId())
             changed = True
 
@@ -173,7 +410,8 @@ class ChunkManager(object):
             self.chunks[chash].cleanup()
             del self.chunks[chash]
 
-        assert len(self.chunks) == len(self.chunkList)
+        assert self.parsedLines is not None or \
+               len(self.chunks) == len(self.chunkList)
 
         return changed
 
@@ -18,6 +18,15 @@ defaultConfig = {
     'vtextStdoutHighlight'  : 'gui=bold guifg=#666666', # guifg=None to disable
     'vtextPriority'         : 200,
 
+    # the number of expression outputs kept per line (e.g. inside of loops)
+    'maxExprOutputs'        : 10,
+
+    # the stdout of running chunks is streamed (at most every
+    # stdoutFlushInterval seconds), only the last maxStdoutLines lines of a
+    # chunk are kept
+    'stdoutFlushInterval'   : 0.2,
+    'maxStdoutLines'        : 10000,
+
     # liveTriggerEvents:    the vim events that trigger the live callback
     # liveCommand:          the command to run when the live callback gets
     #                       called while live mode is enabled
@@ -29,6 +38,19 @@ defaultConfig = {
     'liveCommand'           : 'TshunkyPyRunAllInvalid',
     'semiLiveCommand'       : 'TshunkyPyUpdate', #None to disable
 
+    # live runs are delayed by liveDebounceFactor times the average time of
+    # the previous runs (at most liveDebounceMax seconds), the triggers in
+    # the meantime are merged into one run
+    'liveDebounceFactor'    : 0.5,
+    'liveDebounceMax'       : 1.0,
+
+    # execute the invalid chunks in the background after each update
+    # (TshunkyPyUpdate, semi-live mode), their results stay hidden till a run
+    # (TshunkyPyRunAllInvalid,...) shows them. Speculative runs give way to
+    # every other request. The chunks get executed without being asked to,
+    # don't enable it for chunks with side effects you care about
+    'speculativeRuns'       : False,
+
     # whether the key mapping should be mapped in insert mode
     'enableInsertKeymaps'   : True,
 
@@ -40,13 +62,89 @@ defaultConfig = {
                 'TshunkyPyRunFirstInvalid'  : '<M-f>',
                 'TshunkyPyRunRange'         : '<M-r>',
                 'TshunkyPyLive'             : '<M-x>',
+                'TshunkyPyInterrupt'        : '<M-c>',
                 'TshunkyPyShowStdout'       : '<M-o>',
                 'TshunkyPyQuit'             : '<M-q>'},
 
-    # this option fixes a small bug, but it cost some computational time
-    # if you're having issues with vtext positioning first try to set this
-    # option to False.'
-    'reuseCodeObjects'      : False,
+    # every buffer has its own kernel (process), at most maxKernels of them
+    # are kept (None -> unlimited). Beyond it the least recently used idle one
+    # gets stopped, its results are gone. Only maxRunningKernels (None -> the
+    # number of cpus) of them execute chunks at once, the others wait in the
+    # order they asked to run
+    'maxKernels'            : 8,
+    'maxRunningKernels'     : None,
+
+    # how the execution state of each chunk is saved:
+    # 'copy':   the namespace is (partially) copied for every chunk
+    # 'fork':   (linux only) every chunk keeps a forked and paused process
+    #           around, the os shares the memory copy on write. Works for non
+    #           copyable objects (file handles,...) as well
+    # maxCheckpoints: the number of forked processes that are kept at most,
+    #                 missing ones are recreated by replaying chunks
+    'snapshotEngine'        : 'copy',
+    'maxCheckpoints'        : 16,
+
+    # (copy snapshotEngine) big numpy arrays (and pandas objects if pandas'
+    # copy_on_write mode is enabled) are passed to the chunks that only read
+    # them as read-only views instead of copies. Chunks that write to them
+    # after all fail (the buffer is shared read-only)
+    'shareBuffers'          : True,
+
+    # (copy snapshotEngine) how the values of a type are copied for the chunks
+    # that might mutate them, keyed by type name ('pandas.DataFrame' or
+    # 'pandas.core.frame.DataFrame', subclasses included):
+    # 'share':          not at all
+    # 'shallow':        copy.copy
+    # 'copy':           value.copy()
+    # 'deep':           copy.deepcopy
+    # 'module:func':    a custom function that returns the copy
+    # Immutable values, functions, classes and (by default) numpy and pandas
+    # objects have builtin strategies, everything else is deep copied. The
+    # copy time per type is part of TshunkyPyProfile
+    'copyStrategies'        : {},
+
+    # cache the results of the chunks on disk, so they survive restarts
+    # diskCacheDir:     None -> $XDG_CACHE_HOME/tshunkyPy
+    # diskCacheSize:    the max size of the cache of a project in MB
+    # (not available for the fork snapshotEngine)
+    'diskCache'             : False,
+    'diskCacheDir'          : None,
+    'diskCacheSize'         : 1024,
+
+    # the memory (in MB, None -> unlimited) the snapshots of the chunks may
+    # use (copy snapshotEngine). Beyond it the snapshots that are cheap to
+    # recompute compared to their size get compressed and spilled to disk
+    # (snapshotSpill) or dropped. Dropped ones are rebuilt by executing
+    # their chunk again when they are needed
+    'snapshotMemory'        : None,
+    'snapshotSpill'         : True,
+
+    # modules that stay loaded once a chunk imported them, they are shared
+    # between all chunks instead of being copied and reimported
+    # stableModules:        the (top level) names of those packages
+    # autoStableModules:    everything installed into the python installation
+    #                       (stdlib, site-packages) is stable as well
+    # preImportModules:     modules that get imported when the kernel starts
+    'stableModules'         : [],
+    'autoStableModules'     : True,
+    'preImportModules'      : [],
+
+    # the time budgets (in seconds, None to disable) of a chunk / a run
+    # (TshunkyPyRunAll,...). Chunks that exceed them get interrupted (not
+    # available on windows), the ones after the run budget is used up are not
+    # started
+    'chunkTimeout'          : None,
+    'runTimeout'            : None,
+
+    # cache the compiled chunks (by source), moved chunks get their line
+    # numbers relocated instead of being compiled again. False -> compile
+    # every chunk each time it gets executed
+    'reuseCodeObjects'      : True,
+
+    # measure the memory each chunk allocates (-> TshunkyPyProfile), this
+    # slows down the execution noticeably. Otherwise the size of the names a
+    # chunk changed is estimated
+    'profileMemory'         : False,
 }
 
 config = ConfigDict()
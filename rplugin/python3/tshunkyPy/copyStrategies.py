@@ -0,0 +1,176 @@
+from .config import config
+from .warmModules import isStableModule
+
+import sys
+import copy
+import dill
+import types
+import logging
+import importlib
+import dataclasses
+
+# values of these (exact) types can't be mutated, they are never copied
+_immutableTypes = {int, float, complex, bool, str, bytes, range, slice,
+                   type(None), type(Ellipsis), type(NotImplemented),
+                   types.CodeType, types.BuiltinFunctionType}
+# the max depth isImmutable looks into tuples, frozensets,...
+_maxImmutableDepth = 4
+
+
+def isImmutable(value, depth=_maxImmutableDepth):
+    """Whether value and everything it contains can't be mutated: the
+    immutable builtins and tuples, frozensets and frozen dataclasses of
+    them"""
+    t = type(value)
+    if t in _immutableTypes:
+        return True
+    if depth == 0:
+        return False
+
+    # (not for subclasses with a __dict__, namedtuples are fine)
+    if isinstance(value, (tuple, frozenset)) and \
+       not hasattr(value, '__dict__'):
+        return all(isImmutable(v, depth-1) for v in value)
+    if _isFrozenDataclass(t):
+        return all(isImmutable(getattr(value, f.name), depth-1)
+                   for f in dataclasses.fields(value))
+    return False
+
+def _isFrozenDataclass(t):
+    params = getattr(t, '__dataclass_params__', None)
+    return params is not None and params.frozen
+
+
+# the strategies: they return the copy of a value
+
+def _share(value):
+    return value
+
+def _copyMethod(value):
+    return value.copy()
+
+def _copyIfMutable(value):
+    return value if isImmutable(value) else copy.deepcopy(value)
+
+def _copyModule(value):
+    # stable modules are shared
+    if isStableModule(value.__name__, value):
+        return value
+    return dill.copy(value)
+
+def _copyArray(value):
+    # the objects of object arrays need to be copied as well
+    if value.dtype.hasobject:
+        return copy.deepcopy(value)
+    return value.copy()
+
+def _copyPandas(value):
+    # with copy on write pandas copies the data itself once it gets mutated
+    pd = sys.modules['pandas']
+    if getattr(pd.options.mode, 'copy_on_write', False) is True:
+        return value.copy(deep=False)
+    return value.copy(deep=True)
+
+_namedStrategies = {'share': _share, 'shallow': copy.copy,
+                    'deep': copy.deepcopy, 'copy': _copyMethod}
+
+# the strategies of types that are not configured (-> config.copyStrategies).
+# Functions and classes are copied by reference! Otherwise their __globals__
+# field gets invalid
+_builtinStrategies = {
+    'builtins.function': _share,
+    'builtins.type': _share,
+    'builtins.module': _copyModule,
+    'builtins.tuple': _copyIfMutable,
+    'builtins.frozenset': _copyIfMutable,
+    'datetime.date': _share,
+    'datetime.time': _share,
+    'datetime.timedelta': _share,
+    'datetime.tzinfo': _share,
+    'decimal.Decimal': _share,
+    'fractions.Fraction': _share,
+    'enum.Enum': _share,
+    'uuid.UUID': _share,
+    'pathlib.PurePath': _share,
+    'numpy.ndarray': _copyArray,
+    'numpy.generic': _share,
+    'numpy.dtype': _share,
+    'pandas.DataFrame': _copyPandas,
+    'pandas.Series': _copyPandas,
+    'pandas.Index': _share,
+}
+
+# type -> (the name it's reported as, the strategy)
+_resolved = {}
+_resolvedConfig = {}
+
+
+def _typeNames(t):
+    # the names a type can be configured by: its full name and the one
+    # relative to its top level package (pandas.core.frame.DataFrame ->
+    # pandas.DataFrame)
+    module = getattr(t, '__module__', None) or 'builtins'
+    name = f'{module}.{t.__qualname__}'
+    yield name
+    package = module.partition('.')[0]
+    if package != module:
+        yield f'{package}.{t.__qualname__}'
+    if module == 'builtins':
+        yield t.__qualname__
+
+def _loadStrategy(spec):
+    if callable(spec):
+        return spec
+    if spec in _namedStrategies:
+        return _namedStrategies[spec]
+
+    # 'module:function'
+    moduleName, _, funcName = str(spec).partition(':')
+    try:
+        return getattr(importlib.import_module(moduleName), funcName)
+    except Exception:
+        logging.warning('tshunkyPy: unknown copy strategy %r, using deep',
+                        spec)
+        return copy.deepcopy
+
+def _resolve(t):
+    configured = _resolvedConfig
+    for base in t.__mro__:
+        for name in _typeNames(base):
+            if name in configured:
+                return name, _loadStrategy(configured[name])
+            if name in _builtinStrategies:
+                return name, _builtinStrategies[name]
+
+    if _isFrozenDataclass(t):
+        return f'{t.__module__}.{t.__qualname__}', _copyIfMutable
+    return f'{t.__module__}.{t.__qualname__}', copy.deepcopy
+
+
+def copyValue(value, memo=None):
+    """Copies a value of the namespace (-> Chunk._executeInProcess) with the
+    strategy of its type, returns (the copy, the name of the type's entry)
+
+    The strategies are looked up along the mro of the type in
+    config.copyStrategies first and in the builtin ones (functions, classes,
+    modules, immutable and scientific types) afterwards. Types without one
+    are deep copied, values of immutable types are never copied. Deep copies
+    that share memo keep sharing the objects they have in common.
+    """
+    t = type(value)
+    if t in _immutableTypes:
+        return value, 'immutable'
+
+    # (an empty lua table is a list)
+    configured = config.copyStrategies or {}
+    if _resolvedConfig != configured:
+        _resolved.clear()
+        _resolvedConfig.clear()
+        _resolvedConfig.update(configured)
+
+    if t not in _resolved:
+        _resolved[t] = _resolve(t)
+    name, strategy = _resolved[t]
+    if strategy is copy.deepcopy:
+        return copy.deepcopy(value, memo), name
+    return strategy(value), name
@@ -0,0 +1,150 @@
+from .config import config
+
+import os
+import io
+import dill
+import types
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+
+
+def stableHash(*parts):
+    # str.__hash__ is randomized per process, this one is not
+    return hashlib.sha1('\0'.join(parts).encode()).hexdigest()
+
+def _rebuildFunction(code, globalState, name, defaults, closure, kwdefaults,
+                     qualname, fdict):
+    f = types.FunctionType(code, globalState, name, defaults, closure)
+    f.__kwdefaults__ = kwdefaults
+    f.__qualname__ = qualname
+    f.__dict__.update(fdict)
+    return f
+
+def _isNumpyArray(obj):
+    t = type(obj)
+    return t.__name__ == 'ndarray' and t.__module__ == 'numpy'
+
+
+class _Pickler(dill.Pickler):
+    # the functions defined in the exec environment need to keep the
+    # (GlobalsWrapper) globalState as __globals__, it is pickled as reference
+    # and replaced by the globalState of the chunk that gets restored
+    def __init__(self, file, globalState, **kwargs):
+        super().__init__(file, **kwargs)
+        self.globalState = globalState
+
+    def persistent_id(self, obj):
+        return 'globalState' if obj is self.globalState else None
+
+    def reducer_override(self, obj):
+        if self.proto >= 5 and _isNumpyArray(obj):
+            # dill's reducer of numpy arrays ignores protocol 5 (out-of-band
+            # buffers), numpy's own one doesn't
+            return obj.__reduce_ex__(self.proto)
+
+        if not isinstance(obj, types.FunctionType) or \
+           obj.__globals__ is not self.globalState:
+            return NotImplemented
+
+        return _rebuildFunction, (obj.__code__, self.globalState,
+                                  obj.__name__, obj.__defaults__,
+                                  obj.__closure__, obj.__kwdefaults__,
+                                  obj.__qualname__, obj.__dict__)
+
+class _Unpickler(dill.Unpickler):
+    def __init__(self, file, globalState, **kwargs):
+        super().__init__(file, **kwargs)
+        self.globalState = globalState
+
+    def persistent_load(self, pid):
+        assert pid == 'globalState'
+        return self.globalState
+
+def dumpState(obj, globalState, **kwargs):
+    # pickles (parts of) the state of a chunk, see _Pickler. kwargs are
+    # passed to the pickler (protocol, buffer_callback,...)
+    data = io.BytesIO()
+    _Pickler(data, globalState, **kwargs).dump(obj)
+    return data.getvalue()
+
+def loadState(data, globalState, **kwargs):
+    return _Unpickler(io.BytesIO(data), globalState, **kwargs).load()
+
+
+class DiskCache:
+    """A persistent cache of the results and namespace deltas of chunks
+
+    The entries are keyed by the (stable) chunk hash and the filename. Each
+    project (-> the closest parent directory containing a .git directory)
+    gets its own cache directory. If it grows beyond config.diskCacheSize (MB)
+    the least recently used entries get evicted.
+    """
+    def __init__(self):
+        if config.diskCacheDir:
+            self.baseDir = Path(config.diskCacheDir).expanduser()
+        else:
+            xdgCache = os.environ.get('XDG_CACHE_HOME', '~/.cache')
+            self.baseDir = Path(xdgCache).expanduser() / 'tshunkyPy'
+
+    def _projectDir(self, filename):
+        path = Path(filename).absolute()
+        root = next((p for p in path.parents if (p / '.git').exists()),
+                    path.parent)
+        return self.baseDir / stableHash(root.as_posix())
+
+    def _entryPath(self, chash, filename):
+        return self._projectDir(filename) / stableHash(chash, filename)
+
+    def restore(self, chash, chunk):
+        path = self._entryPath(chash, chunk.filename)
+        if not path.exists():
+            return False
+
+        try:
+            with open(path, 'rb') as f:
+                entry = _Unpickler(f, chunk.globalState).load()
+        except Exception:
+            logging.debug('restoring %s failed', chunk.getDebugId())
+            return False
+
+        # mark as recently used
+        os.utime(path)
+
+        start = chunk.lineRange.start
+        chunk.restore(entry['delta'], entry['deleted'], entry['stdout'],
+                      {start + lno: t for lno, t in entry['vtexts'].items()})
+        return True
+
+    def store(self, chash, chunk):
+        start = chunk.lineRange.start
+        entry = {'delta': chunk.delta, 'deleted': chunk.deleted,
+                 'stdout': chunk.stdout,
+                 'vtexts': {lno - start: t for lno, t in chunk.vtexts.items()}}
+
+        try:
+            data = dumpState(entry, chunk.globalState)
+        except Exception:
+            logging.debug('%s is not cacheable', chunk.getDebugId())
+            return
+
+        path = self._entryPath(chash, chunk.filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+
+        self._evict(path.parent)
+
+    def _evict(self, directory):
+        entries = [(e.stat().st_mtime, e.stat().st_size, e.path)
+                        for e in os.scandir(directory)]
+        size = sum(e[1] for e in entries)
+        maxSize = config.diskCacheSize * 1024 * 1024
+
+        for _, entrySize, path in sorted(entries):
+            if size <= maxSize:
+                break
+            os.remove(path)
+            size -= entrySize
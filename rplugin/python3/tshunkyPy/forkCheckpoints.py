@@ -0,0 +1,158 @@
+from .chunk import executeCode
+from .profiler import MemoryProbe
+from .config import config
+
+import os
+import time
+import marshal
+import logging
+from collections import OrderedDict
+from multiprocessing.connection import Listener, Client
+
+
+def _serveCheckpoint(conn, address, namespace):
+    # the loop of a checkpoint process: it's paused until it gets asked to
+    # fork. The forked child executes the requested chunks and becomes the
+    # checkpoint of the last one
+    children = set()
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break
+        if request[0] != 'fork':
+            break
+
+        # reap the checkpoints that got dropped in the meantime
+        for pid in list(children):
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                children.remove(pid)
+
+        _, token, replays, code, filename, firstLine, lastLine, budget = \
+                request
+        pid = os.fork()
+        if pid:
+            children.add(pid)
+            conn.send(pid)
+            continue
+
+        # the child
+        children = set()
+        conn.close()
+        conn = Client(address)
+        conn.send(token)
+
+        # replay the chunks whose checkpoints are gone (outputs are dropped)
+        for c in replays:
+            _, _, valid = executeCode(marshal.loads(c), namespace, namespace,
+                                      filename, 0, 0)
+            if not valid:
+                conn.send(('result', ('', {lastLine:
+                                ['replaying a chunk failed']}, False), {}))
+                os._exit(0)
+
+        before = dict(namespace)
+        cpu = time.process_time()
+        probe = MemoryProbe()
+        result = executeCode(marshal.loads(code), namespace, namespace,
+                             filename, firstLine, lastLine, budget,
+                             lambda *out: conn.send(('stdout',) + out))
+        delta = {k: v for k, v in namespace.items() if before.get(k) is not v}
+        stats = dict(probe.result(delta), cpu=time.process_time() - cpu)
+        conn.send(('result', result, stats))
+
+        # only the state of successfully executed chunks is kept
+        if not result[2]:
+            break
+
+    os._exit(0)
+
+
+class CheckpointEngine:
+    """A snapshot engine based on fork()
+
+    Instead of copying the namespace, every executed chunk keeps a paused
+    process (checkpoint) around. Executing a chunk forks the checkpoint of its
+    prevChunk, this way the namespace gets shared copy on write by the os.
+    Only config.maxCheckpoints checkpoints are kept, if the checkpoint of the
+    prevChunk is gone, the chunks are replayed from the closest checkpoint.
+    """
+    def __init__(self, inheritedConns=None):
+        self.listener = Listener(family='AF_UNIX')
+        self.address = self.listener.address
+        self.checkpoints = OrderedDict()
+        self.token = 0
+
+        self.root = self._fork(inheritedConns or [])
+
+    def _fork(self, inheritedConns):
+        # fork the root checkpoint with an empty namespace
+        pid = os.fork()
+        if pid == 0:
+            for c in inheritedConns:
+                c.close()
+            conn = Client(self.address)
+            _serveCheckpoint(conn, self.address, {})
+
+        self.rootPid = pid
+        return self.listener.accept()
+
+    def execute(self, chunk, budget=None, onOutput=None):
+        # find the closest chunk with a checkpoint
+        base, replays = chunk.prevChunk, []
+        while base.prevChunk and base not in self.checkpoints:
+            replays.append(base)
+            base = base.prevChunk
+
+        if base.prevChunk:
+            self.checkpoints.move_to_end(base)
+            baseConn = self.checkpoints[base]
+        else:
+            baseConn = self.root
+
+        if replays:
+            logging.debug('replaying %s chunks', len(replays))
+
+        self.token += 1
+        baseConn.send(('fork', self.token,
+                       [marshal.dumps(c.compile()) for c in reversed(replays)],
+                       marshal.dumps(chunk.compile()),
+                       chunk.filename, chunk.lineRange.start,
+                       chunk.lineRange.stop - 1, budget))
+        baseConn.recv()
+
+        conn = self.listener.accept()
+        assert conn.recv() == self.token
+
+        # the stdout is streamed while the chunk is running
+        msg = conn.recv()
+        while msg[0] == 'stdout':
+            if onOutput:
+                onOutput(*msg[1:])
+            msg = conn.recv()
+        _, (stdout, vtexts, valid), stats = msg
+        chunk.stats.update(stats)
+
+        if valid:
+            self.drop(chunk)
+            self.checkpoints[chunk] = conn
+            while len(self.checkpoints) > max(config.maxCheckpoints, 1):
+                _, c = self.checkpoints.popitem(last=False)
+                c.close()
+        else:
+            conn.close()
+
+        return stdout, vtexts, valid
+
+    def drop(self, chunk):
+        conn = self.checkpoints.pop(chunk, None)
+        if conn:
+            conn.close()
+
+    def quit(self):
+        for conn in self.checkpoints.values():
+            conn.close()
+        self.checkpoints.clear()
+        self.root.close()
+        os.waitpid(self.rootPid, 0)
+        self.listener.close()
@@ -0,0 +1,311 @@
+from .chunkManager import ChunkManager
+from .chunk import enableInterrupts
+from .forkCheckpoints import CheckpointEngine
+from .outputManager import ChunkView
+from .warmModules import preImportModules
+from .config import config
+
+import os
+import sys
+import signal
+import logging
+import threading
+import multiprocessing
+from pathlib import Path
+from collections import deque
+
+# the requests that replace a run that is going on (-> Kernel._superseded)
+_supersedingRequests = {'runAll', 'runAllInvalid', 'runFirstInvalid',
+                        'runRange', 'supersede', 'quit'}
+
+class KernelOutputManager:
+    """The OutputManager of the kernel process
+
+    It does not display anything, but forwards the state of the chunks to the
+    OutputManager of the nvim process (-> KernelClient)
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        # the chunks executed by a speculative run (-> Kernel.speculate) are
+        # not shown till they get revealed (id -> chunk)
+        self.hiding = False
+        self.hidden = {}
+
+    def update(self, chunk):
+        # valid hidden chunks stay hidden, reset ones are shown as they are
+        if self.hiding or (chunk.valid and id(chunk) in self.hidden):
+            self.hidden[id(chunk)] = chunk
+            return
+        self.hidden.pop(id(chunk), None)
+        self.conn.send(('update', ChunkView(chunk)))
+
+    def streamStdout(self, chunk, lines, partial):
+        # the new lines of stdout of a chunk that is still running
+        if not self.hiding:
+            self.conn.send(('stdout', id(chunk), lines, partial))
+
+    def delete(self, chunk):
+        self.hidden.pop(id(chunk), None)
+        self.conn.send(('delete', id(chunk)))
+
+    def reveal(self, chunks=None):
+        # shows the hidden chunks (all of them by default)
+        for chunk in list(self.hidden.values()) if chunks is None else chunks:
+            del self.hidden[id(chunk)]
+            self.conn.send(('update', ChunkView(chunk)))
+
+    def setSyntaxError(self, e, lineRange=None):
+        self.conn.send(('syntaxError', e, lineRange))
+
+    def setLayout(self, chunks):
+        layout = [(id(c), c.lineRange.start, c.lineRange.stop) for c in chunks]
+        self.conn.send(('layout', layout))
+
+
+class Kernel:
+    """Owns the ChunkManager and executes the requests of a KernelClient
+
+    Requests are tuples (command, edits, filename, *args), each request is
+    acknowledged with a ('done', command) message after all the chunk updates
+    it caused got sent. edits are the changes of the buffer since the last
+    request (-> BufferShadow), the kernel keeps its own copy of the lines.
+
+    Runs are stale as soon as a newer run got requested, they are cancelled
+    at the next chunk boundary (-> ChunkManager.cancelCheck). Plain updates
+    don't cancel them. Speculative runs (-> speculate) are cancelled by any
+    request.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.lines = []
+        # the requests that got received while checking for newer ones
+        self.inbox = deque()
+        self.outputManager = KernelOutputManager(conn)
+
+        self.checkpoints = None
+        if config.snapshotEngine == 'fork':
+            if hasattr(os, 'fork'):
+                self.checkpoints = CheckpointEngine([conn])
+            else:
+                logging.warning('tshunkyPy: the fork snapshot engine is ' +
+                                'not available on this platform')
+
+        self.chunkManager = ChunkManager(self.outputManager, self.checkpoints)
+        self.chunkManager.cancelCheck = self._superseded
+
+    def run(self):
+        while True:
+            try:
+                request = self.inbox.popleft() if self.inbox \
+                                               else self.conn.recv()
+            except EOFError:
+                break
+
+            cmd, args = request[0], request[1:]
+            if cmd == 'quit':
+                break
+
+            try:
+                getattr(self, cmd)(*args)
+            except Exception:
+                logging.exception('tshunkyPy kernel: %s failed', cmd)
+            self.conn.send(('done', cmd))
+
+        if self.checkpoints:
+            self.checkpoints.quit()
+
+    def _applyEdits(self, edits):
+        # returns the (0 based, end exclusive) range of lines that changed
+        # (start, oldEnd, newEnd) or None if all lines got replaced
+        full, dirty = False, None
+        for first, last, lines in edits:
+            if last == -1:
+                self.lines = list(lines)
+                full = True
+                continue
+
+            self.lines[first:last] = lines
+            newEnd = first + len(lines)
+            if dirty is None:
+                dirty = (first, last, newEnd)
+                continue
+
+            # merge with the previous edits, everything in between counts as
+            # changed as well
+            start, oldEnd, curEnd = dirty
+            end = max(curEnd, last)
+            dirty = (min(start, first), oldEnd + end - curEnd,
+                     end + newEnd - last)
+
+        return None if full else dirty
+
+    def _superseded(self):
+        # whether a newer run waits (or the kernel quits)
+        try:
+            while self.conn.poll():
+                self.inbox.append(self.conn.recv())
+        except EOFError:
+            self.inbox.append(('quit',))
+
+        return any(r[0] in _supersedingRequests for r in self.inbox)
+
+    def update(self, edits, filename):
+        if edits is None:
+            # nothing changed
+            return False
+
+        dirty = self._applyEdits(edits)
+        changed = self.chunkManager.update('\n'.join(self.lines), filename,
+                                           dirty)
+        self.outputManager.setLayout(self.chunkManager._getOrderedChunks())
+        return changed
+
+    def supersede(self, edits, filename):
+        # the update of a run that waits for a slot (-> KernelPool), the run
+        # that is going on is replaced by it
+        self.update(edits, filename)
+
+    def _pending(self):
+        # whether any request waits
+        self._superseded()
+        return bool(self.inbox)
+
+    def speculate(self, edits, filename):
+        # an update that executes the invalid chunks in the background
+        # (config.speculativeRuns), their results stay hidden till the next
+        # run reveals them
+        self.update(edits, filename)
+        if self._pending():
+            return
+
+        self.outputManager.hiding = True
+        self.chunkManager.cancelCheck = self._pending
+        try:
+            self.chunkManager.executeAllInvalidChunks()
+        finally:
+            self.chunkManager.cancelCheck = self._superseded
+            self.outputManager.hiding = False
+
+    def _run(self, edits, filename, execute, *args):
+        # the edits are needed in any case, the run only if it's up to date.
+        # It shows the results of the speculative runs first
+        self.update(edits, filename)
+        if not self._superseded():
+            self.outputManager.reveal()
+            execute(*args)
+
+    def runAll(self, edits, filename):
+        self._run(edits, filename, self.chunkManager.executeAllChunks)
+
+    def runAllInvalid(self, edits, filename):
+        self._run(edits, filename, self.chunkManager.executeAllInvalidChunks)
+
+    def runFirstInvalid(self, edits, filename):
+        # the first chunk that looks invalid might be executed already
+        self.update(edits, filename)
+        if self._superseded():
+            return
+
+        hidden = self.outputManager.hidden
+        for chunk in self.chunkManager._getOrderedChunks():
+            if id(chunk) in hidden:
+                self.outputManager.reveal([chunk])
+                return
+            if not chunk.valid:
+                break
+        self.chunkManager.executeFirstInvalidChunk()
+
+    def runRange(self, edits, filename, selectedRange):
+        self._run(edits, filename, self.chunkManager.executeRange,
+                  selectedRange)
+
+    def exportTrace(self, edits, filename, path):
+        self.update(edits, filename)
+        self.chunkManager.trace.export(path)
+
+
+def kernelMain(conn, kernelConfig):
+    # the stdout of the plugin host is the rpc channel to nvim, make sure
+    # nothing (not even c extensions) writes to it
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+
+    config.update(kernelConfig)
+
+    # interrupting the kernel (-> KernelClient.interrupt) interrupts the
+    # checkpoint processes (if any) as well, only the one executing a chunk
+    # cares
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+    enableInterrupts()
+
+    # before the checkpoints get forked, they all share them
+    preImportModules()
+    Kernel(conn).run()
+
+
+class KernelClient:
+    """Runs a Kernel in a separate process
+
+    Requests are sent asynchronously, the messages of the kernel are passed
+    to callback in the thread of the nvim event loop. All messages that are
+    available at once are passed together (as list).
+    """
+    def __init__(self, nvim, callback):
+        self.nvim = nvim
+        self.callback = callback
+
+        # the (spawned) kernel needs to be able to import tshunkyPy
+        pluginPath = Path(__file__).parent.parent.as_posix()
+        if pluginPath not in sys.path:
+            sys.path.append(pluginPath)
+
+        ctx = multiprocessing.get_context('spawn')
+        self.conn, kernelConn = ctx.Pipe()
+        self.process = ctx.Process(target=kernelMain,
+                                   args=(kernelConn, dict(config)),
+                                   daemon=True)
+        self.process.start()
+        kernelConn.close()
+
+        self.quitting = False
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    @property
+    def alive(self):
+        return not self.quitting and self.process.is_alive()
+
+    def send(self, *request):
+        self.conn.send(request)
+
+    def _read(self):
+        while True:
+            try:
+                msgs = [self.conn.recv()]
+                while self.conn.poll():
+                    msgs.append(self.conn.recv())
+            except (EOFError, OSError):
+                break
+            self.nvim.async_call(self.callback, msgs)
+
+        if not self.quitting:
+            self.nvim.async_call(self.callback, [('died', self.process.pid)])
+
+    def interrupt(self):
+        # interrupts the chunk that is being executed
+        if hasattr(os, 'killpg'):
+            os.killpg(self.process.pid, signal.SIGINT)
+        else:
+            os.kill(self.process.pid, signal.SIGINT)
+
+    def quit(self):
+        self.quitting = True
+        try:
+            self.send('quit')
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
@@ -0,0 +1,211 @@
+from .kernel import KernelClient
+from .config import config
+
+import os
+import logging
+from collections import OrderedDict, deque
+
+# the requests that execute chunks, they need a slot of the KernelPool.
+# Speculative runs (-> Kernel.speculate) only get one if it's free
+_runRequests = {'runAll', 'runAllInvalid', 'runFirstInvalid', 'runRange',
+                'speculate'}
+
+
+class PooledKernel:
+    """The kernel of a buffer as part of a KernelPool
+
+    It has the interface of a KernelClient, but the process is started with
+    the first request (again, after it got evicted or died). Runs wait for a
+    slot of the pool, the edits they carry are sent right away
+    (-> Kernel.supersede), so the layout is up to date and a run of the
+    kernel that is still going on gets cancelled (-> Kernel._superseded).
+    """
+    def __init__(self, pool, callback):
+        self.pool = pool
+        self.callback = callback
+        self.client = None
+
+        # the runs that wait for a slot
+        self.queue = deque()
+        # the requests (runs) that got sent, but are not done yet
+        self.pending = 0
+        self.runs = 0
+        # the 'done' messages of the updates split off the waiting runs are
+        # not passed on
+        self.splitUpdates = 0
+        self.speculating = 0
+        self.slot = False
+
+    @property
+    def alive(self):
+        return self.client is not None and self.client.alive
+
+    @property
+    def idle(self):
+        return not (self.slot or self.pending or self.queue)
+
+    def send(self, cmd, edits, filename, *args):
+        if cmd not in _runRequests or \
+           self.pool.acquire(self, wait=cmd != 'speculate'):
+            self._send((cmd, edits, filename) + args)
+            return
+
+        if cmd == 'speculate':
+            self._send(('update', edits, filename))
+            return
+
+        self.splitUpdates += 1
+        self._send(('supersede', edits, filename))
+        self.queue.append((cmd, None, filename) + args)
+
+    def _send(self, request):
+        if self.client is None:
+            self.client = self.pool.start(self)
+        self.pool.touch(self)
+
+        self.pending += 1
+        if request[0] in _runRequests:
+            self.runs += 1
+        if request[0] == 'speculate':
+            self.speculating += 1
+        self.client.send(*request)
+
+    def flush(self):
+        # got a slot
+        while self.queue:
+            self._send(self.queue.popleft())
+
+    def _onMessages(self, msgs):
+        forward = []
+        for msg in msgs:
+            if msg[0] == 'done':
+                self.pending -= 1
+                if msg[1] in _runRequests:
+                    self.runs -= 1
+                if msg[1] == 'speculate':
+                    self.speculating -= 1
+                elif msg[1] in ('update', 'supersede') and \
+                     self.splitUpdates:
+                    self.splitUpdates -= 1
+                    continue
+            elif msg[0] == 'died':
+                self.client = None
+                self._reset()
+            forward.append(msg)
+
+        if self.slot and not self.runs:
+            self.pool.release(self)
+        self.callback(forward)
+
+    def _reset(self):
+        self.pending, self.runs, self.splitUpdates = 0, 0, 0
+        self.speculating = 0
+        self.queue.clear()
+        self.pool.remove(self)
+
+    def preempt(self):
+        # cancels the speculative runs, any request does (an empty update)
+        if self.speculating:
+            self.splitUpdates += 1
+            self._send(('update', None, None))
+
+    def interrupt(self):
+        # the runs that wait for a slot are dropped
+        dropped = [('done', r[0]) for r in self.queue]
+        self.queue.clear()
+        if self.client:
+            self.client.interrupt()
+        if dropped:
+            self.callback(dropped)
+
+    def evict(self):
+        # stops the (idle) process, the state of the buffer is gone
+        self.client.quit()
+        self.client = None
+        self.callback([('evicted',)])
+
+    def quit(self):
+        if self.client:
+            self.client.quit()
+            self.client = None
+        self._reset()
+
+
+class KernelPool:
+    """Bounds the kernel processes of all buffers
+
+    At most config.maxKernels kernels are kept, beyond it the least recently
+    used idle one gets stopped. Only config.maxRunningKernels of them execute
+    chunks at once, the others wait for a slot in the order they asked for one.
+    A kernel that holds a slot gives it up as soon as its runs are done, new
+    runs go to the back of the queue if other kernels are waiting. Speculative
+    runs don't wait and get cancelled when another kernel needs to.
+    """
+    def __init__(self, nvim):
+        self.nvim = nvim
+        # the started kernels, least recently used first
+        self.kernels = OrderedDict()
+        self.running = set()
+        self.waiting = deque()
+
+    @property
+    def slots(self):
+        return config.maxRunningKernels or os.cpu_count() or 1
+
+    def kernel(self, callback):
+        return PooledKernel(self, callback)
+
+    def start(self, kernel):
+        idle = [k for k in self.kernels if k.idle]
+        while config.maxKernels and idle and \
+              len(self.kernels) >= config.maxKernels:
+            k = idle.pop(0)
+            logging.debug('evicting an idle kernel')
+            self.kernels.pop(k)
+            k.evict()
+
+        self.kernels[kernel] = None
+        return KernelClient(self.nvim, kernel._onMessages)
+
+    def touch(self, kernel):
+        if kernel in self.kernels:
+            self.kernels.move_to_end(kernel)
+
+    def acquire(self, kernel, wait=True):
+        # whether kernel may run now, otherwise it waits for a slot (if wait)
+        if kernel.slot and not self.waiting:
+            return True
+        if not kernel.slot and not self.waiting and \
+           len(self.running) < self.slots:
+            self.running.add(kernel)
+            kernel.slot = True
+            return True
+
+        if wait and kernel not in self.waiting and not kernel.slot:
+            self.waiting.append(kernel)
+            # speculative runs give way
+            for k in self.running:
+                k.preempt()
+        return False
+
+    def release(self, kernel):
+        self.running.discard(kernel)
+        kernel.slot = False
+        if kernel.queue:
+            self.waiting.append(kernel)
+
+        while self.waiting and len(self.running) < self.slots:
+            k = self.waiting.popleft()
+            if not k.queue:
+                # interrupted in the meantime
+                continue
+            self.running.add(k)
+            k.slot = True
+            k.flush()
+
+    def remove(self, kernel):
+        self.kernels.pop(kernel, None)
+        if kernel in self.waiting:
+            self.waiting.remove(kernel)
+        if kernel.slot:
+            self.release(kernel)
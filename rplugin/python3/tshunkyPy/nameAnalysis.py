@@ -0,0 +1,587 @@
+from .warmModules import isStableModule
+
+import ast
+import sys
+import types
+import functools
+from collections import deque
+
+# calls to these builtins (may) access the namespace in ways that can't be
+# analysed statically
+dynamicAccessFunctions = {'globals', 'locals', 'vars', 'eval', 'exec'}
+
+
+class NameCollector(ast.NodeVisitor):
+    """Collects all names an ast node refers to"""
+    def __init__(self):
+        self.names = set()
+        self.dynamic = False
+
+    def visit_Name(self, node):
+        self.names.add(node.id)
+
+    def visit_Global(self, node):
+        self.names.update(node.names)
+
+    def visit_Nonlocal(self, node):
+        self.names.update(node.names)
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Name) and \
+           node.func.id in dynamicAccessFunctions:
+            self.dynamic = True
+        self.generic_visit(node)
+
+
+def _codeNames(code):
+    # all global (and attribute) names used by a code object and the code
+    # objects nested in it (inner functions, lambdas, comprehensions,...)
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(_codeNames(const))
+    return names
+
+def _classFunctions(cls, globalState):
+    # the functions of the exec environment among the methods (and
+    # properties) of a class
+    for klass in cls.__mro__:
+        for attr in vars(klass).values():
+            if isinstance(attr, (staticmethod, classmethod)):
+                attr = attr.__func__
+            if isinstance(attr, property):
+                attrs = [attr.fget, attr.fset, attr.fdel]
+            else:
+                attrs = [attr]
+            for a in attrs:
+                if isinstance(a, types.FunctionType) and \
+                   a.__globals__ is globalState:
+                    yield a
+
+
+# values of these types contain nothing the walk (-> _reachable) cares about
+_atomicTypes = {int, float, complex, bool, str, bytes, type(None)}
+# the max number of objects _reachable looks at per chunk
+_maxReachable = 10000
+# Py_TPFLAGS_HEAPTYPE
+_heapTypeFlag = 1 << 9
+
+class _Unresolvable(Exception):
+    pass
+
+def _isLibraryType(t):
+    # objects of stable (installed) modules are not looked into. The classes
+    # defined in the exec environment claim to be builtins, unlike the real
+    # ones they are heap types
+    if t.__module__ == 'builtins':
+        return not t.__flags__ & _heapTypeFlag
+    module = sys.modules.get(t.__module__)
+    return module is not None and isStableModule(t.__module__, module)
+
+def _pushItems(stack, items):
+    # big containers of atomic values are skipped at c speed
+    if len(items) > 100 and set(map(type, items)) <= _atomicTypes:
+        return
+    stack.extend(items)
+
+def _reachable(value, globalState, aliases, visited):
+    """Returns the functions of the exec environment and the names of the
+    namespace (aliases: id of the value -> names) that can be reached from
+    value through containers, attributes, bound methods, partials and
+    closures. Raises _Unresolvable if there are too many objects to look at.
+    """
+    functions, names = [], []
+    classes = set()
+    stack = [value]
+    while stack:
+        v = stack.pop()
+        t = type(v)
+        if t in _atomicTypes:
+            continue
+        if v is not value and id(v) in aliases:
+            # walked on its own (-> mutableGlobals)
+            names.extend(aliases[id(v)])
+            continue
+        if id(v) in visited:
+            continue
+        visited.add(id(v))
+        if len(visited) > _maxReachable:
+            raise _Unresolvable()
+
+        if isinstance(v, types.FunctionType):
+            if v.__globals__ is globalState:
+                functions.append(v)
+                _pushItems(stack, list(v.__defaults__ or ()) +
+                                  list((v.__kwdefaults__ or {}).values()))
+                for cell in v.__closure__ or ():
+                    try:
+                        stack.append(cell.cell_contents)
+                    except ValueError:
+                        # empty cell
+                        pass
+        elif isinstance(v, types.MethodType):
+            stack.extend((v.__func__, v.__self__))
+        elif isinstance(v, functools.partial):
+            stack.append(v.func)
+            _pushItems(stack, list(v.args) + list(v.keywords.values()))
+        elif isinstance(v, type):
+            functions.extend(_classFunctions(v, globalState))
+        elif isinstance(v, dict):
+            _pushItems(stack, list(v.keys()))
+            _pushItems(stack, list(v.values()))
+        elif isinstance(v, (list, tuple, set, frozenset, deque)):
+            _pushItems(stack, list(v))
+        elif isinstance(v, types.ModuleType) or _isLibraryType(t):
+            continue
+        else:
+            if t not in classes:
+                classes.add(t)
+                functions.extend(_classFunctions(t, globalState))
+            attrs = getattr(v, '__dict__', None)
+            if isinstance(attrs, dict):
+                _pushItems(stack, list(attrs.values()))
+            for klass in t.__mro__:
+                for slot in getattr(klass, '__slots__', ()):
+                    if isinstance(slot, str) and hasattr(v, slot):
+                        stack.append(getattr(v, slot))
+
+    return functions, names
+
+def mutableGlobals(node, namespace, globalState):
+    """Returns the names of namespace a chunk (node) might mutate.
+
+    These are all the names the chunk refers to and -- transitively -- all the
+    names of the values and functions these can reach (-> _reachable) and the
+    names the functions refer to. Everything else is not reachable by the
+    chunk and can be shared with the previous chunk.
+    """
+    collector = NameCollector()
+    collector.visit(node)
+    if collector.dynamic:
+        return set(namespace.keys())
+
+    # values that are bound to a name and reachable through another one
+    aliases = {}
+    for k, v in namespace.items():
+        if type(v) not in _atomicTypes:
+            aliases.setdefault(id(v), []).append(k)
+
+    todo = [n for n in collector.names if n in namespace]
+    mutable = set()
+    visited, visitedCode = set(), set()
+    while todo:
+        name = todo.pop()
+        if name in mutable:
+            continue
+        mutable.add(name)
+
+        try:
+            functions, names = _reachable(namespace[name], globalState,
+                                          aliases, visited)
+        except _Unresolvable:
+            return set(namespace.keys())
+        todo.extend(names)
+        # names bound to the same value
+        todo.extend(aliases.get(id(namespace[name]), []))
+
+        for func in functions:
+            if func.__code__ in visitedCode:
+                continue
+            visitedCode.add(func.__code__)
+            names = _codeNames(func.__code__)
+            if names & dynamicAccessFunctions:
+                return set(namespace.keys())
+            todo.extend(n for n in names if n in namespace)
+
+    return mutable
+
+def _objectIds(value):
+    # the ids of the objects a (deep) copy of value copies as well. Functions,
+    # classes and modules are shared by reference (-> copyValue)
+    ids = set()
+    stack = [value]
+    while stack:
+        v = stack.pop()
+        t = type(v)
+        if t in _atomicTypes or id(v) in ids or \
+           isinstance(v, (types.FunctionType, type, types.ModuleType)):
+            continue
+        ids.add(id(v))
+        if len(ids) > _maxReachable:
+            raise _Unresolvable()
+
+        if isinstance(v, types.MethodType):
+            stack.append(v.__self__)
+        elif isinstance(v, dict):
+            _pushItems(stack, list(v.keys()))
+            _pushItems(stack, list(v.values()))
+        elif isinstance(v, (list, tuple, set, frozenset, deque)):
+            _pushItems(stack, list(v))
+        elif not _isLibraryType(t):
+            attrs = getattr(v, '__dict__', None)
+            if isinstance(attrs, dict):
+                _pushItems(stack, list(attrs.values()))
+            for klass in t.__mro__:
+                for slot in getattr(klass, '__slots__', ()):
+                    if isinstance(slot, str) and hasattr(v, slot):
+                        stack.append(getattr(v, slot))
+    return ids
+
+def sharingNames(names, candidates, namespace):
+    """Returns the names of candidates whose values share objects with the
+    values of names (or -- transitively -- with the ones of such a candidate)
+
+    A chunk that mutates such a value mutates the values of all of them, they
+    need to stay together (-> Chunk.delta).
+    """
+    candidates = set(candidates) - set(names)
+    try:
+        objects = {k: _objectIds(namespace[k]) for k in names}
+        if not any(objects.values()):
+            return set()
+        objects.update((k, _objectIds(namespace[k])) for k in candidates)
+    except _Unresolvable:
+        return candidates
+
+    reached = set().union(*(objects[k] for k in names))
+    sharing = set()
+    changed = True
+    while changed:
+        changed = False
+        for k in candidates - sharing:
+            if objects[k] & reached:
+                sharing.add(k)
+                reached |= objects[k]
+                changed = True
+    return sharing
+
+
+# calls to these builtins are assumed not to mutate their arguments
+pureFunctions = {'print', 'len', 'repr', 'str', 'int', 'float', 'bool',
+                 'type', 'isinstance', 'issubclass', 'range', 'sorted',
+                 'list', 'tuple', 'dict', 'set', 'frozenset', 'min', 'max',
+                 'sum', 'abs', 'any', 'all', 'enumerate', 'zip', 'id', 'hash',
+                 'format', 'round', 'divmod', 'hex', 'oct', 'bin', 'chr', 'ord'}
+
+def _rootName(node):
+    # x.a[1].b -> x
+    while isinstance(node, (ast.Attribute, ast.Subscript, ast.Starred)):
+        node = node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+def _assignedAliases(node):
+    # the (target, source) names an assignment makes share a value
+    # (x = y, x.a = y[0],...)
+    if isinstance(node, ast.Assign):
+        targets = node.targets
+    elif isinstance(node, ast.AnnAssign) and node.value:
+        targets = [node.target]
+    else:
+        return []
+    if not isinstance(node.value, (ast.Name, ast.Attribute, ast.Subscript)):
+        return []
+    source = _rootName(node.value)
+    return [(_rootName(t), source) for t in targets
+                if source and _rootName(t)]
+
+def itemWrites(node):
+    """Returns the names whose items or attributes a statement assigns or
+    deletes (x[i] = ..., x.a = ..., del x[i]) or augments (x += ...)
+
+    Unlike the writes of NodeInfo these are definite mutations, method calls
+    are not considered.
+    """
+    names = set()
+    for n in ast.walk(node):
+        if isinstance(n, (ast.Subscript, ast.Attribute)) and \
+           not isinstance(n.ctx, ast.Load):
+            names.add(_rootName(n))
+        elif isinstance(n, ast.AugAssign) and isinstance(n.target, ast.Name):
+            # read and (for mutable values) modified in place
+            names.add(n.target.id)
+    names.discard(None)
+    return names
+
+def readOnlyNames(node):
+    """Returns the names a statement reads itself, but doesn't write to
+    (-> itemWrites) or call the methods of (x.sort(), x.a[0].fill(0),...)
+
+    The values of these names can be shared read-only (-> sharedCopy), the
+    names the called functions access are not included.
+    """
+    names = set()
+    receivers = set()
+    for n in ast.walk(node):
+        if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load):
+            names.add(n.id)
+        elif isinstance(n, ast.Call) and isinstance(n.func, ast.Attribute):
+            receivers.add(_rootName(n.func.value))
+    return names - receivers - itemWrites(node)
+
+
+class NodeInfo(ast.NodeVisitor):
+    """Collects the names a top level statement reads, writes and binds
+
+    reads / writes:         names read / (possibly) written or mutated when
+                            the statement gets executed
+    binds:                  names that are definitely (re)bound by the
+                            statement
+    lazyReads / lazyWrites: names read / written by the functions (and
+                            lambdas) defined in the statement, they are
+                            accessed when the function gets called
+    barrier:                the statement accesses the namespace dynamically
+                            (globals(), eval(...), from x import *,...)
+    """
+    def __init__(self, node):
+        self.reads, self.writes, self.binds = set(), set(), set()
+        self.lazyReads, self.lazyWrites = set(), set()
+        self.barrier = False
+
+        # > 0 while visiting function bodies / class bodies
+        self.funcDepth = 0
+        self.classDepth = 0
+
+        self.visit(node)
+        self.binds = self._bindings(node)
+        self.writes |= self.binds
+
+    def _bindings(self, node):
+        def names(target):
+            if isinstance(target, ast.Name):
+                return [target.id]
+            if isinstance(target, ast.Starred):
+                return names(target.value)
+            if isinstance(target, (ast.Tuple, ast.List)):
+                return [n for elt in target.elts for n in names(elt)]
+            return []
+
+        if isinstance(node, ast.Assign):
+            return {n for target in node.targets for n in names(target)}
+        if isinstance(node, ast.AnnAssign):
+            return set(names(node.target)) if node.value else set()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                             ast.ClassDef)):
+            return {node.name}
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            return {(a.asname or a.name).split('.')[0] for a in node.names
+                                                        if a.name != '*'}
+        return set()
+
+    def _read(self, name):
+        (self.lazyReads if self.funcDepth else self.reads).add(name)
+
+    def _write(self, name):
+        if not name:
+            return
+        (self.lazyWrites if self.funcDepth else self.writes).add(name)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self._read(node.id)
+        elif not self.funcDepth and not self.classDepth:
+            self.writes.add(node.id)
+
+    def visit_AugAssign(self, node):
+        # x += 1 reads x (and might mutate it in place), it doesn't bind it
+        # definitely
+        if isinstance(node.target, ast.Name):
+            self._read(node.target.id)
+        self.generic_visit(node)
+
+    def visit_Global(self, node):
+        for name in node.names:
+            self._write(name)
+
+    def _visitMutation(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            self._write(_rootName(node))
+        self.generic_visit(node)
+
+    visit_Attribute = _visitMutation
+    visit_Subscript = _visitMutation
+
+    def visit_Call(self, node):
+        func = node.func
+        if isinstance(func, ast.Name) and func.id in dynamicAccessFunctions:
+            self.barrier = True
+
+        # methods might mutate their object
+        if isinstance(func, ast.Attribute):
+            self._write(_rootName(func.value))
+
+        # ... and functions their arguments
+        if not (isinstance(func, ast.Name) and func.id in pureFunctions):
+            for arg in node.args + [k.value for k in node.keywords]:
+                self._write(_rootName(arg))
+
+        self.generic_visit(node)
+
+    def _visitImport(self, node):
+        if any(a.name == '*' for a in node.names):
+            self.barrier = True
+        for a in node.names:
+            if a.name != '*':
+                self._write((a.asname or a.name).split('.')[0])
+
+    visit_Import = _visitImport
+    visit_ImportFrom = _visitImport
+
+    def _visitFunction(self, node):
+        # decorators, defaults and annotations get evaluated when the
+        # function is defined, the body when it is called
+        for d in getattr(node, 'decorator_list', []):
+            self.visit(d)
+        if not isinstance(node, ast.Lambda):
+            if node.returns:
+                self.visit(node.returns)
+            if not self.funcDepth and not self.classDepth:
+                self.writes.add(node.name)
+        args = node.args
+        for default in args.defaults + [d for d in args.kw_defaults if d]:
+            self.visit(default)
+
+        self.funcDepth += 1
+        body = node.body if isinstance(node.body, list) else [node.body]
+        for stmt in body:
+            self.visit(stmt)
+        self.funcDepth -= 1
+
+    visit_FunctionDef = _visitFunction
+    visit_AsyncFunctionDef = _visitFunction
+    visit_Lambda = _visitFunction
+
+    def visit_ClassDef(self, node):
+        for n in node.decorator_list + node.bases + node.keywords:
+            self.visit(n)
+        if not self.funcDepth and not self.classDepth:
+            self.writes.add(node.name)
+
+        self.classDepth += 1
+        for stmt in node.body:
+            self.visit(stmt)
+        self.classDepth -= 1
+
+    def visit_comprehension(self, node):
+        # the targets are local to the comprehension
+        self.visit(node.iter)
+        for i in node.ifs:
+            self.visit(i)
+
+
+class Dataflow:
+    """The def/use graph of the (top level statements) of a source
+
+    The statements get added in order, add(...) returns the indices of the
+    previously added statements a statement depends on. The NodeInfo of a
+    statement can be passed in if it's known already.
+    """
+    def __init__(self):
+        self.infos = []
+        # the names a statement might write (including the names the functions
+        # it calls might write), None if unknown (-> barrier)
+        self.writes = []
+        # the lazy reads / writes a statement "provides" (including the ones of
+        # the statements it depends on, it might have stored references to
+        # their functions)
+        self.lazy = []
+        # name -> indices of the statements that might have written name since
+        # it got bound the last time
+        self.writers = {}
+        self.barriers = []
+        # name -> the names whose values share objects with its value (found
+        # at runtime -> addWrites), mutating one mutates the others
+        self.links = {}
+
+    def _writersOf(self, name):
+        return self.writers.get(name, self.barriers)
+
+    def add(self, node, info=None):
+        info = info or NodeInfo(node)
+        idx = len(self.infos)
+
+        deps = set()
+        lazyReads, lazyWrites = set(info.lazyReads), set(info.lazyWrites)
+        writes = set(info.writes)
+
+        todo = list(info.reads)
+        # lambdas (or functions) in compound statements might get called right
+        # away, the bodies of function and class definitions don't
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                                 ast.ClassDef)):
+            todo.extend(info.lazyReads)
+            writes |= info.lazyWrites
+
+        if info.barrier:
+            deps = set(range(idx))
+            for r, w in self.lazy:
+                lazyReads |= r
+                lazyWrites |= w
+                writes |= w
+
+        seen, linked = set(), set()
+        while True:
+            # the statement depends on the writers of the names linked to
+            # the ones it mutates (and mutates them as well)
+            for name in writes - info.binds - linked:
+                linked.add(name)
+                todo.extend(self.links.get(name, ()))
+                writes |= self.links.get(name, set())
+            if not todo:
+                break
+
+            name = todo.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            for i in self._writersOf(name):
+                if i in deps:
+                    continue
+                deps.add(i)
+                # calling the functions of our dependencies accesses their
+                # lazy reads and writes
+                r, w = self.lazy[i]
+                lazyReads |= r
+                lazyWrites |= w
+                writes |= w
+                todo.extend(r)
+
+        self.infos.append(info)
+        self.lazy.append((lazyReads, lazyWrites))
+        self.writes.append(writes if not info.barrier else None)
+
+        if info.barrier:
+            for name, writers in self.writers.items():
+                self.writers[name] = writers + [idx]
+            self.barriers = self.barriers + [idx]
+
+        for name in writes:
+            if name in info.binds:
+                self.writers[name] = [idx]
+                # a rebound name doesn't share objects with anything
+                for other in self.links.pop(name, ()):
+                    self.links[other].discard(name)
+            else:
+                self.writers[name] = self._writersOf(name) + [idx]
+
+        # the other links are found at runtime (-> addWrites)
+        for target, source in _assignedAliases(node):
+            self._link({target, source})
+
+        return deps
+
+    def _link(self, names):
+        for name in names:
+            self.links.setdefault(name, set()).update(names - {name})
+
+    def addWrites(self, names):
+        # names the last added statement turned out to mutate (at runtime),
+        # their values share objects with the ones of the names it wrote
+        idx = len(self.infos) - 1
+        writes = self.writes[idx]
+        if not names or writes is None:
+            return
+
+        self._link(writes | set(names))
+        for name in set(names) - writes:
+            writes.add(name)
+            self.writers[name] = self._writersOf(name) + [idx]
@@ -1,16 +1,20 @@
-from .chunkManager import ChunkManager
 from .outputManager import OutputManager
-from .utils.nvimUtils import createBuffer, modifiable, NvimLock
+from .utils.nvimUtils import createBuffer, modifiable
+from .utils.bufferShadow import BufferShadow
+from .utils.liveScheduler import LiveScheduler
+from .profiler import formatReport
 from .config import config, TshunkyPyKeymap
 
 from pynvim import Nvim
 from pynvim.api.common import NvimError
 from textwrap import wrap
+import os
+import time
 from contextlib import suppress
 
 class NvimInterface:
 
-    def __init__(self, nvim: Nvim):
+    def __init__(self, nvim: Nvim, kernelPool):
         self.nvim = nvim
 
         self.buf = self.nvim.current.buffer
@@ -18,11 +22,19 @@ class NvimInterface:
 
         self.outputManager = OutputManager(self.nvim)
         self.keymapManager = TshunkyPyKeymap(self.nvim)
-        self.chunkManager = ChunkManager(self.outputManager)
+        self.kernel = kernelPool.kernel(self.kernelCallback)
+        self.shadow = BufferShadow(self.buf)
 
         self.liveMode = False
         self.popupBuffer = None
-        self.nlock = NvimLock(nvim)
+        self.profileBuffer = None
+
+        # the number of requests the kernel didn't finish yet and since when
+        # it's busy with them
+        self.pendingRequests = 0
+        self.busySince = 0
+        self.liveScheduler = LiveScheduler(self.nvim, lambda:
+                                self.shadow.dirty or not self.pendingRequests)
 
         self.initAutoCmds()
 
@@ -57,13 +69,19 @@ class NvimInterface:
         self.nvim.api.command(f'lua vim.diagnostic.enable({self.buf.handle})')
 
         # cleanup managers
+        self.liveScheduler.cancel()
+        self.shadow.detach()
+        self.kernel.quit()
         self.keymapManager.restore()
         self.outputManager.quit()
 
-        # delete buffer
+        # delete buffers
         if self.popupBuffer:
             self.nvim.api.command(f'bw {self.popupBuffer.handle}')
             self.popupBuffer = None
+        if self.profileBuffer:
+            self.nvim.api.command(f'bw {self.profileBuffer.handle}')
+            self.profileBuffer = None
 
     def cursorMoved(self):
         if not self.popupBuffer:
@@ -82,13 +100,12 @@ class NvimInterface:
     def cursorHold(self):
         # get vtexts and stdout of "selected" chunk and prepare it
         lineno, col = self.nvim.funcs.getpos('.')[1:-1]
-        chunk = self.chunkManager._getChunkByLine(lineno)
+        chunk = self.outputManager.getViewByLine(lineno)
         if not chunk:
             return
 
-        lines = [l for chunk in self.chunkManager._getOrderedChunks()
-                   if lineno in chunk.vtexts.keys()
-                   for l in '\n'.join(chunk.vtexts[lineno]).split('\n')]
+        lines = [l for t in self.outputManager.getVtextsByLine(lineno)
+                   for l in t.split('\n')]
 
         if chunk.stdout:
             lines.extend(chunk.stdout.rstrip('\n').split('\n'))
@@ -126,9 +143,9 @@ class NvimInterface:
 
     def liveCallback(self):
         if self.liveMode and config.liveCommand:
-            self.nvim.api.command(config.liveCommand)
+            self.liveScheduler.trigger(config.liveCommand)
         elif not self.liveMode and config.semiLiveCommand:
-            self.nvim.api.command(config.semiLiveCommand)
+            self.liveScheduler.trigger(config.semiLiveCommand)
 
     def live(self):
         self.liveMode =  not self.liveMode
@@ -138,54 +155,112 @@ class NvimInterface:
         else:
             self.outputManager.echo('tshunkyPy live mode is disabled')
 
-    def _update_raw(self):
-        source = '\n'.join(self.buf[:])
-        return self.chunkManager.update(source, self.buf.name)
+    def kernelCallback(self, msgs):
+        for msg in msgs:
+            self._handleKernelMessage(*msg)
+
+        # render all changes at once
+        self.outputManager.flush()
+
+    def _handleKernelMessage(self, cmd, *args):
+        if cmd == 'update':
+            self.outputManager.update(*args)
+        elif cmd == 'stdout':
+            self.outputManager.streamStdout(*args)
+        elif cmd == 'delete':
+            self.outputManager.delete(*args)
+        elif cmd == 'layout':
+            self.outputManager.setLayout(*args)
+        elif cmd == 'syntaxError':
+            self.outputManager.setSyntaxError(*args)
+        elif cmd == 'done':
+            self.pendingRequests -= 1
+            if not self.pendingRequests:
+                self.liveScheduler.measured(time.monotonic() - self.busySince)
+        elif cmd in ('died', 'evicted'):
+            # the state of the kernel is gone, the next request starts over
+            # with a new one (-> KernelPool)
+            if cmd == 'died':
+                msg = 'tshunkyPy kernel died, restarting....'
+            else:
+                msg = f'tshunkyPy: stopped the idle kernel of {self.buf.name}'
+            self.outputManager.echo(msg)
+            self.outputManager.clear()
+            self.shadow.resync()
+            self.pendingRequests = 0
+
+    def _request(self, cmd, *args):
+        # the kernel executes the requests asynchronously and streams the
+        # results back (-> kernelCallback). Only the edits since the last
+        # request are sent
+        edits = self.shadow.sync()
+        if not self.pendingRequests:
+            self.busySince = time.monotonic()
+        self.pendingRequests += 1
+        self.kernel.send(cmd, edits, self.buf.name, *args)
 
     def update(self):
-        with self.nlock:
-            self._update_raw()
+        self._request('speculate' if config.speculativeRuns else 'update')
 
     def runAll(self):
-        with self.nlock:
-            self._update_raw()
-            self.chunkManager.executeAllChunks()
+        self._request('runAll')
 
     def runAllInvalid(self):
-        with self.nlock:
-            self._update_raw()
-            self.chunkManager.executeAllInvalidChunks()
+        self._request('runAllInvalid')
 
     def runFirstInvalid(self):
-        with self.nlock:
-            self._update_raw()
-            self.chunkManager.executeFirstInvalidChunk()
+        self._request('runFirstInvalid')
 
     def runRange(self, selectedRange):
         # keep visual selection
         if len(selectedRange) > 1:
             self.nvim.api.input('gv')
-        with self.nlock:
-            self._update_raw()
-            self.chunkManager.executeRange(selectedRange)
+        self._request('runRange', selectedRange)
+
+    def interrupt(self):
+        self.liveScheduler.cancel()
+        self.kernel.interrupt()
+
+    def exportTrace(self, path=None):
+        path = os.path.expanduser(path or
+                                  self.buf.name + '.tshunkyPy.trace.json')
+        self._request('exportTrace', path)
+        self.outputManager.echo(f'tshunkyPy: exporting the trace to {path}')
 
     def showStdout(self):
         stdoutBuf = self.outputManager.stdoutBuffer
         assert stdoutBuf
 
-        mainWinId = self.nvim.current.window.handle
-
         winid = self.nvim.funcs.bufwinid(stdoutBuf.handle)
         if winid == -1:
-            mainWinWidth = self.nvim.current.window.width
-            mainWinHeight = self.nvim.current.window.height
-            if mainWinWidth > 80:
-                self.nvim.command(f'vsp #{stdoutBuf.handle}')
-                self.nvim.current.window.width = int(mainWinWidth / 3)
-            else:
-                self.nvim.command(f'sp #{stdoutBuf.handle}')
-                self.nvim.current.window.height = int(mainWinHeight / 3)
-            stdoutBuf.api.set_option('buflisted', False)
-            self.nvim.funcs.win_gotoid(mainWinId)
+            self._openSplit(stdoutBuf)
         else:
             self.nvim.api.win_close(winid, True)
+
+    def profile(self):
+        # the chunks ranked by their costs (of their last execution)
+        if not self.profileBuffer or not self.profileBuffer.valid:
+            self.profileBuffer = createBuffer(self.nvim, False,
+                                buftype='nofile',
+                                name = self.buf.name + '.tshunkyPy.profile')
+
+        with modifiable(self.profileBuffer):
+            self.profileBuffer[:] = formatReport(
+                                        self.outputManager.getOrderedViews(),
+                                        self.shadow.lines or self.buf[:])
+
+        if self.nvim.funcs.bufwinid(self.profileBuffer.handle) == -1:
+            self._openSplit(self.profileBuffer)
+
+    def _openSplit(self, buf):
+        mainWinId = self.nvim.current.window.handle
+        mainWinWidth = self.nvim.current.window.width
+        mainWinHeight = self.nvim.current.window.height
+        if mainWinWidth > 80:
+            self.nvim.command(f'vsp #{buf.handle}')
+            self.nvim.current.window.width = int(mainWinWidth / 3)
+        else:
+            self.nvim.command(f'sp #{buf.handle}')
+            self.nvim.current.window.height = int(mainWinHeight / 3)
+        buf.api.set_option('buflisted', False)
+        self.nvim.funcs.win_gotoid(mainWinId)
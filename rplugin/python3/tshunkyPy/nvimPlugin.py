@@ -1,8 +1,9 @@
 from .nvimInterface import NvimInterface
+from .kernelPool import KernelPool
 from .config import config
-from .utils.nvimUtils import NvimLock
+from .utils.jobQueue import JobQueue
 
-from pynvim import Nvim, plugin, command, function
+from pynvim import Nvim, plugin, command, function, rpc_export
 
 
 @plugin
@@ -13,74 +14,113 @@ class NvimPlugin:
         self.nvimInterfaces = {}
         self.nvim = nvim
 
-        self.lock = NvimLock(self.nvim)
+        # the jobs of each buffer are run one after another
+        self.jobQueues = {}
 
         luaConfig = self.nvim.exec_lua('return require("tshunkyPy").getConfig()')
         if luaConfig:
             config.update(luaConfig)
 
-    def getInterface(self):
-        with self.lock:
-            bufId = self.nvim.current.buffer.handle
-            if bufId not in self.nvimInterfaces.keys():
-                self.nvimInterfaces[bufId] = NvimInterface(self.nvim)
-            return self.nvimInterfaces[bufId]
+        # the kernels (processes) of all buffers
+        self.kernelPool = KernelPool(nvim)
+
+    def submit(self, bufId, method, *args):
+        # calls method of the NvimInterface of the buffer (-> JobQueue)
+        if bufId not in self.jobQueues.keys():
+            self.jobQueues[bufId] = JobQueue()
+        self.jobQueues[bufId].submit(self._runJob, bufId, method, args)
+
+    def submitCurrent(self, method, *args):
+        self.submit(self.nvim.current.buffer.handle, method, *args)
+
+    def _runJob(self, bufId, method, args):
+        if method == 'quit':
+            if bufId in self.nvimInterfaces.keys():
+                self.nvimInterfaces.pop(bufId).quit()
+            return
+
+        if bufId not in self.nvimInterfaces.keys():
+            self.nvimInterfaces[bufId] = NvimInterface(self.nvim,
+                                                        self.kernelPool)
+        getattr(self.nvimInterfaces[bufId], method)(*args)
 
     @command('TshunkyPy', sync=synced)
     def init(self):
-        self.getInterface()
-        self.update()
+        self.submitCurrent('update')
 
     @command('TshunkyPyQuit', sync=synced)
     def quit(self):
-        bufId = self.nvim.current.buffer.handle
-        self.getInterface().quit()
-        del self.nvimInterfaces[bufId]
+        self.submitCurrent('quit')
 
     @command('TshunkyPyLive', sync=synced)
     def live(self):
-        self.getInterface().live()
+        self.submitCurrent('live')
 
     @command('TshunkyPyUpdate', sync=synced)
     def update(self):
-        self.getInterface().update()
+        self.submitCurrent('update')
 
     @command('TshunkyPyRunAll', sync=synced)
     def runAll(self):
-        self.getInterface().runAll()
+        self.submitCurrent('runAll')
 
     @command('TshunkyPyRunAllInvalid', sync=synced)
     def runAllInvalid(self):
-        self.getInterface().runAllInvalid()
+        self.submitCurrent('runAllInvalid')
 
     @command('TshunkyPyRunFirstInvalid', sync=synced)
     def runFirstInvalid(self):
-        self.getInterface().runFirstInvalid()
+        self.submitCurrent('runFirstInvalid')
 
     @command('TshunkyPyRunRange', range='', sync=synced)
     def runRange(self, srange):
-        self.getInterface().runRange(range(srange[0], srange[1]+1))
+        self.submitCurrent('runRange', range(srange[0], srange[1]+1))
+
+    @command('TshunkyPyInterrupt', sync=synced)
+    def interrupt(self):
+        self.submitCurrent('interrupt')
 
     @command('TshunkyPyShowStdout', sync=synced)
     def showStdout(self):
-        self.getInterface().showStdout()
+        self.submitCurrent('showStdout')
+
+    @command('TshunkyPyProfile', sync=synced)
+    def profile(self):
+        self.submitCurrent('profile')
 
-    def getInterfaceFromArgs(self, args):
+    @command('TshunkyPyProfileExport', nargs='?', complete='file',
+             sync=synced)
+    def exportTrace(self, args):
+        self.submitCurrent('exportTrace', *args)
+
+    def submitFromArgs(self, args, method):
         assert len(args) == 1
         bufID = int(args[0])
         assert bufID
-        assert bufID in self.nvimInterfaces.keys()
-        return self.nvimInterfaces[bufID]
+        if bufID in self.nvimInterfaces.keys():
+            self.submit(bufID, method)
 
     @function('TshunkyPyLiveCallback', sync=False)
     def liveCallback(self, args):
-        self.getInterfaceFromArgs(args).liveCallback()
+        self.submitFromArgs(args, 'liveCallback')
 
     @function('TshunkyPyCursorMovedCallback', sync=False)
     def cursorMoved(self, args):
-        self.getInterfaceFromArgs(args).cursorMoved()
+        self.submitFromArgs(args, 'cursorMoved')
 
     @function('TshunkyPyCursorHoldCallback', sync=False)
     def cursorHold(self, args):
-        self.getInterfaceFromArgs(args).cursorHold()
-
+        self.submitFromArgs(args, 'cursorHold')
+
+    # buffer updates of the buffers attached by the BufferShadows
+    @rpc_export('nvim_buf_lines_event', sync=False)
+    def bufLinesEvent(self, buf, changedtick, firstline, lastline, linedata,
+                      more):
+        if buf.handle in self.nvimInterfaces.keys():
+            self.nvimInterfaces[buf.handle].shadow.linesEvent(
+                                            firstline, lastline, linedata)
+
+    @rpc_export('nvim_buf_detach_event', sync=False)
+    def bufDetachEvent(self, buf):
+        if buf.handle in self.nvimInterfaces.keys():
+            self.nvimInterfaces[buf.handle].shadow.detached()
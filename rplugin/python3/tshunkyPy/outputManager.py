@@ -1,66 +1,109 @@
 from .utils.nvimUtils import modifiable, createBuffer
 from .config import config
 
-from pynvim import Nvim
 from pprint import pformat
+import copy
+from bisect import bisect_right
+
+
+class ChunkView:
+    """The (picklable) output state of a chunk
+
+    The chunks live in the kernel process, the nvim process only knows their
+    views.
+    """
+    def __init__(self, chunk):
+        self.cid = id(chunk)
+        self.prevId = id(chunk.prevChunk)
+        self.valid = chunk.valid
+        self.prevValid = chunk.prevChunk.valid
+        self.lineRange = chunk.lineRange
+        self.vtexts = chunk.vtexts
+        self.stdout = chunk.stdout
+        self.stats = chunk.stats
+        # the chunk is being executed (-> OutputManager.streamStdout), the
+        # complete lines streamed so far and their number
+        self.running = False
+        self.streamed = ('', 0)
+
+    def move(self, lineRange):
+        shift = lineRange.start - self.lineRange.start
+        if shift:
+            self.vtexts = {lno + shift: t for lno, t in self.vtexts.items()}
+        self.lineRange = lineRange
 
 
 class ChunkOutputHandler:
-    def  __init__(self, cid, buf, nvim: Nvim, vtextPos='eol'):
-        self.nvim = nvim
-        self.buf = buf
-        self.vtextPos = vtextPos
+    """Creates the render plan entries (-> tshunkyPy.render(...)) of a chunk
 
-        self.id = str(cid)
+    Each chunk gets its own extmark namespace. The handler remembers what it
+    rendered last, an entry only contains the extmarks that need to be
+    (re)placed or deleted.
+    """
+    def  __init__(self, cid, vtextPos='eol'):
+        self.vtextPos = vtextPos
+        self.ns = f'tshunkyPyVirtualText{cid}'
 
-        self.vtext_ns = self.nvim.api.create_namespace(
-                                    f'tshunkyPyVirtualText{self.id}')
-        self.signIds = []
+        # key -> [row, extmark opts] / extmark id
+        self.rendered = {}
+        self.ids = {}
+        self.nextId = 1
 
     def cleanup(self):
+        self.rendered, self.ids = {}, {}
+        return {'ns': self.ns, 'clear': True, 'set': [], 'del': []}
 
-        for sid in self.signIds:
-            self.nvim.funcs.sign_unplace('tshunkyPySigns', {'id': sid})
-
-        if self.vtext_ns:
-            self.buf.api.clear_namespace(self.vtext_ns, 0, -1)
+    def _marks(self, valid, lineRange, vtexts, stdout):
+        marks = {}
 
-        self.signIds = []
-
-    def _placeSign(self, name, lineno):
-        # a (nice(r)) wrapper around sign_place(...)
-        sign_place = self.nvim.funcs.sign_place
-
-        i = sign_place(0, 'tshunkyPySigns', name, self.buf.handle,
-                        {'lnum': lineno, 'priority': 20})
-        self.signIds.append(i)
-
-    def update(self, valid, lineRange, vtexts, stdout):
-        # delete old stuff
-        self.cleanup()
-
-        # place signs and set bg color for invalid chunks
+        # mark invalid chunks with a sign and highlight all of its lines (as
+        # one range)
         if not valid:
-            self._placeSign('tshunkyPyInvalidSign', lineRange.start)
-            for lineno in lineRange:
-                self._placeSign('tshunkyPyInvalidLine', lineno)
+            mark = {'end_row': lineRange.stop - 1, 'end_col': 0,
+                    'hl_group': 'tshunkyPyInvalidLineHl', 'hl_eol': True,
+                    'priority': 20}
+            if config.invalidSign:
+                mark['sign_text'] = config.invalidSign
+                mark['sign_hl_group'] = 'tshunkyPyInvalidSignHl'
+            marks['invalid'] = [lineRange.start - 1, mark]
 
         # display the virtal text messages from vtexts
         for lno, textList in vtexts.items():
-            for text in reversed(textList):
+            for i, text in enumerate(reversed(textList)):
                 s = text.replace('\n', '\\n')
                 vtext = [f'{config.vtextPrompt} ' + s, 'tshunkyPyVTextHl']
                 mark = {'virt_text': [vtext],
                         'priority': config.vtextPriority,
                         'virt_text_pos': self.vtextPos}
-                self.buf.api.set_extmark(self.vtext_ns, lno-1, 0, mark)
+                marks[lno, i] = [lno - 1, mark]
 
         # display virtual text messages from stdout
         if stdout:
             s = stdout.rstrip('\n').replace('\n', '\\n')
             vtext = [f'{config.vtextPrompt} ' + s, 'tshunkyPyVTextStdoutHl']
             mark = {'virt_text': [vtext], 'priority': config.vtextPriority + 1}
-            self.buf.api.set_extmark(self.vtext_ns, lineRange.stop-2, 0, mark)
+            marks['stdout'] = [lineRange.stop - 2, mark]
+
+        return marks
+
+    def update(self, valid, lineRange, vtexts, stdout):
+        # returns None if nothing changed
+        marks = self._marks(valid, lineRange, vtexts, stdout)
+        if marks == self.rendered:
+            return None
+
+        delete = [self.ids.pop(k) for k in self.rendered if k not in marks]
+        place = []
+        for k, (row, opts) in marks.items():
+            if self.rendered.get(k) == [row, opts]:
+                continue
+            if k not in self.ids:
+                self.ids[k] = self.nextId
+                self.nextId += 1
+            place.append([row, dict(opts, id=self.ids[k])])
+
+        self.rendered = marks
+        return {'ns': self.ns, 'clear': False, 'set': place, 'del': delete}
 
 
 class OutputManager:
@@ -70,21 +113,28 @@ class OutputManager:
         self.buf = self.nvim.current.buffer
         self.chunkSignHandlers = {}
 
+        # the views of all chunks (cid -> view) and the cids in buffer order
+        self.views = {}
+        self.layout = []
+        # the first lines of the chunks (in buffer order) and the cids of the
+        # chunks with vtexts at a line (lineno -> [cid, ...], built on demand)
+        self.layoutStarts = []
+        self.vtextIndex = None
+
+        # the views that need to be rendered, the render plan entries of the
+        # deleted handlers (namespace -> entry) and the view the stdout
+        # buffer gets build from. They are pending until the next flush
+        self.pending = {}
+        self.plan = {}
+        self.stdoutView = None
+
         command = self.nvim.api.command
-        sign_define = self.nvim.funcs.sign_define
 
         command('highlight tshunkyPyInvalidSignHl ' +
                 f'{config.invalidSignHighlight}')
         command('highlight tshunkyPyInvalidLineHl ' +
                 f'{config.invalidLineHighlight}')
 
-
-        sign_define('tshunkyPyInvalidSign',
-                    {'text': config.invalidSign,
-                     'texthl': 'tshunkyPyInvalidSignHl'})
-        sign_define('tshunkyPyInvalidLine',
-                    {'linehl': 'tshunkyPyInvalidLineHl'})
-
         command(f'highlight tshunkyPyVTextHl {config.vtextHighlight}')
         command(f'highlight tshunkyPyVTextStdoutHl {config.vtextStdoutHighlight}')
 
@@ -92,6 +142,15 @@ class OutputManager:
             createBuffer(self.nvim, False, buftype='nofile',
                          name = self.buf.name + '.tshunkyPy.stdout')
 
+        # the chunks whose stdout is in the stdoutBuffer (below the title):
+        # [(cid, stdout, line offset), ...] and the number of lines
+        self.stdoutTitle = ['TshunkyPy.stdout:',
+                            '-----------------']
+        self.stdoutChunks = []
+        self.stdoutLines = 0
+        with modifiable(self.stdoutBuffer):
+            self.stdoutBuffer[:] = self.stdoutTitle
+
     def echo(self, x):
         if not isinstance(x, str):
             x = pformat(x)
@@ -99,68 +158,215 @@ class OutputManager:
         x = x.replace('\"', '\'')
         self.nvim.out_write(x + '\n')
 
-    def delete(self, chunk=None, cid=None):
-        assert (chunk == None) != (cid == None)
+    def flush(self):
+        # apply all pending changes with (at most) two requests. Only the
+        # latest state of each chunk is rendered, the handlers skip it if
+        # it's what they rendered last time. The state is committed before
+        # each request, a flush during one (reentrant) starts from it
+        pending, self.pending = self.pending, {}
+        for handler, args in pending.values():
+            entry = handler.update(*args)
+            if not entry:
+                continue
+            if entry['ns'] in self.plan:
+                # the namespace got cleaned up in the meantime
+                entry['clear'] = True
+            self.plan[entry['ns']] = entry
+
+        if self.plan:
+            plan, self.plan = self.plan, {}
+            self.nvim.exec_lua('require("tshunkyPy").render(...)',
+                               self.buf.handle, list(plan.values()))
+
+        if self.stdoutView:
+            view, self.stdoutView = self.stdoutView, None
+            self._updateStdout(view)
+
+    def delete(self, cid):
+        self.views.pop(cid, None)
 
-        if not cid:
-            cid = id(chunk)
         if not cid in self.chunkSignHandlers.keys():
             return
 
-        self.chunkSignHandlers[cid].cleanup()
-        del self.chunkSignHandlers[cid]
+        handler = self.chunkSignHandlers.pop(cid)
+        self.plan[handler.ns] = handler.cleanup()
+        self.pending.pop(cid, None)
 
-    def quit(self):
+    def clear(self):
         for handler in self.chunkSignHandlers.values():
-            handler.cleanup()
+            self.plan[handler.ns] = handler.cleanup()
 
         self.chunkSignHandlers = {}
+        self.pending = {}
+        self.views = {}
+        self.layout = []
+        self.layoutStarts = []
+        self.vtextIndex = None
+        self.stdoutView = None
+        # the next update replaces all of the stdoutBuffer
+        self.stdoutChunks = []
+        self.stdoutLines = 0
+
+    def quit(self):
+        self.clear()
+        self.flush()
         assert self.stdoutBuffer
         self.nvim.command(f'bw {self.stdoutBuffer.handle}')
         self.stdoutBuffer = None
 
-    def update(self, chunk):
-        cid = id(chunk)
+    def setLayout(self, layout):
+        # the chunks might have moved or got new predecessors
+        self.layout = []
+        prevId = None
+        for cid, start, stop in layout:
+            view = self.views[cid]
+            view.move(range(start, stop))
+            if prevId:
+                view.prevId = prevId
+            self.layout.append(cid)
+            prevId = cid
+
+        self.layoutStarts = [start for _, start, _ in layout]
+        self.vtextIndex = None
+
+    def getOrderedViews(self):
+        return [self.views[cid] for cid in self.layout]
+
+    def getViewByLine(self, line):
+        i = bisect_right(self.layoutStarts, line) - 1
+        if i < 0:
+            return None
+        view = self.views[self.layout[i]]
+        return view if line in view.lineRange else None
+
+    def getVtextsByLine(self, line):
+        # the vtexts of all chunks at line (functions print their vtexts at
+        # their definition, even if a later chunk called them)
+        if self.vtextIndex is None:
+            self.vtextIndex = {}
+            for cid in self.layout:
+                for lno in self.views[cid].vtexts.keys():
+                    self.vtextIndex.setdefault(lno, []).append(cid)
+
+        return [t for cid in self.vtextIndex.get(line, [])
+                  for t in self.views[cid].vtexts[line]]
+
+    def update(self, view):
+        cid = view.cid
+        self.views[cid] = view
+        self.vtextIndex = None
+
         # create handler if neccessary
         if not cid in self.chunkSignHandlers.keys():
-            self.chunkSignHandlers[cid] = \
-                    ChunkOutputHandler(cid, self.buf, self.nvim)
+            self.chunkSignHandlers[cid] = ChunkOutputHandler(cid)
 
         # call handler.update
         handler = self.chunkSignHandlers[cid]
-        handler.update(chunk.valid, chunk.lineRange, chunk.vtexts, chunk.stdout)
-
-        # collect stdout and set stdoutBuffer
-        if chunk.valid or chunk.prevChunk.valid:
-            stdoutList = []
-            c = chunk if chunk.valid else chunk.prevChunk
-            while c:
-                if c.stdout:
-                    stdoutList.extend(c.stdout.split('\n'))
-                    if c.stdout.endswith('\n'):
-                        stdoutList.pop()
-                c = c.prevChunk
-
-            assert self.stdoutBuffer
-            stdoutList.reverse()
-
-            title = ['TshunkyPy.stdout:',
-                     '-----------------']
-            with modifiable(self.stdoutBuffer):
-                self.stdoutBuffer[:] = title  + stdoutList
-
-    def setSyntaxError(self, e):
+        self.pending[cid] = (handler, (view.valid, view.lineRange,
+                                       view.vtexts, view.stdout))
+
+        if view.valid or view.prevValid or view.running:
+            self.stdoutView = view
+
+    def streamStdout(self, cid, lines, partial):
+        # the new lines of stdout of a chunk that is still running, they are
+        # appended to the ones streamed so far. Only the last maxStdoutLines
+        # are kept, the ones before are trimmed once in a while
+        if cid not in self.views.keys():
+            return
+        view = copy.copy(self.views[cid])
+        streamed, n = view.streamed if view.running else ('', 0)
+        streamed += lines
+        n += lines.count('\n')
+
+        maxLines = config.maxStdoutLines
+        if maxLines and n > 2 * maxLines:
+            cut = len(streamed)
+            for _ in range(maxLines + 1):
+                cut = streamed.rindex('\n', 0, cut)
+            streamed = f'... ({n - maxLines} lines dropped)\n' + \
+                       streamed[cut + 1:]
+            n = maxLines + 1
+
+        view.streamed = (streamed, n)
+        view.stdout, view.running = streamed + partial, True
+        self.update(view)
+
+    def _updateStdout(self, view):
+        # the stdoutBuffer shows the stdout of all chunks up to view (or its
+        # prevChunk if it's invalid). Only the part after the chunks that
+        # are (still) in the buffer gets replaced
+        chain = []
+        v = view if view.valid or view.running \
+                 else self.views.get(view.prevId)
+        while v:
+            chain.append(v)
+            v = self.views.get(v.prevId)
+        chain.reverse()
+
+        keep = 0
+        for (cid, stdout, _), v in zip(self.stdoutChunks, chain):
+            if cid != v.cid or stdout != v.stdout:
+                break
+            keep += 1
+
+        if keep == len(chain) == len(self.stdoutChunks):
+            return
+
+        # the stdout of a running chunk only got appended to
+        # (-> streamStdout), its complete lines stay as they are
+        cut = 0
+        if keep < min(len(self.stdoutChunks), len(chain)):
+            cid, stdout, _ = self.stdoutChunks[keep]
+            v = chain[keep]
+            if cid == v.cid and stdout and v.stdout and \
+               v.stdout.startswith(stdout):
+                cut = stdout.rfind('\n') + 1
+
+        if keep < len(self.stdoutChunks):
+            offset = self.stdoutChunks[keep][2]
+        else:
+            offset = self.stdoutLines
+
+        # the lines from start on get replaced
+        start = offset
+        stdoutChunks = self.stdoutChunks[:keep]
+        stdoutList = []
+        for v in chain[keep:]:
+            stdoutChunks.append((v.cid, v.stdout, start + len(stdoutList)))
+            stdout = v.stdout
+            if cut:
+                start += stdout.count('\n', 0, cut)
+                stdout, cut = stdout[cut:], 0
+            if stdout:
+                stdoutList.extend(stdout.split('\n'))
+                if stdout.endswith('\n'):
+                    stdoutList.pop()
+
+        self.stdoutChunks = stdoutChunks
+        self.stdoutLines = start + len(stdoutList)
+
+        assert self.stdoutBuffer
+        start += len(self.stdoutTitle)
+        with modifiable(self.stdoutBuffer):
+            self.stdoutBuffer.api.set_lines(start, -1, False, stdoutList)
+
+    def setSyntaxError(self, e, lineRange=None):
+        # lineRange: the lines that could not be parsed (the line of e by
+        # default)
         shash = 'SyntaxError'.__hash__()
 
         if not e:
-            self.delete(cid=shash)
+            self.delete(shash)
             return
 
         if not shash in self.chunkSignHandlers.keys():
             self.chunkSignHandlers[shash] = \
-                    ChunkOutputHandler(shash, self.buf, self.nvim, 'right_align')
+                    ChunkOutputHandler(shash, 'right_align')
 
         handler = self.chunkSignHandlers[shash]
 
-        handler.update(False, range(e.lineno, e.lineno + 1),
-                       {e.lineno: ['SyntaxError']}, '')
+        if not lineRange:
+            lineRange = range(e.lineno, e.lineno + 1)
+        self.pending[shash] = (handler, (False, lineRange,
+                                         {e.lineno: ['SyntaxError']}, ''))
@@ -0,0 +1,124 @@
+from .config import config
+from .snapshotStore import estimateSize
+
+import json
+import time
+import tracemalloc
+from collections import deque
+
+# the max number of events a TraceLog keeps
+_maxTraceEvents = 100000
+
+
+class MemoryProbe:
+    """Measures the memory allocated while it's active (-> tracemalloc)
+
+    size is the memory that is still held at the end (the snapshot of the
+    chunk), peak the max memory that was held in between. Only active if
+    config.profileMemory is set, tracing slows the execution down. Otherwise
+    size is estimated from the delta of the chunk (-> estimateSize).
+    """
+    def __init__(self):
+        self.enabled = config.profileMemory
+        if not self.enabled:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            return
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self.start = tracemalloc.get_traced_memory()[0]
+
+    def result(self, delta):
+        # delta: the names the chunk (re)bound or mutated
+        if not self.enabled:
+            return {'size': estimateSize(delta)}
+        current, peak = tracemalloc.get_traced_memory()
+        return {'size': current - self.start, 'peak': peak - self.start}
+
+
+class TraceLog:
+    """The executions of the chunks as Chrome trace events
+
+    The exported json file can be loaded by chrome://tracing or
+    ui.perfetto.dev. The chunk events contain the stats of the chunk, the
+    compile and copy phases are nested into them.
+    """
+    def __init__(self):
+        self.events = deque(maxlen=_maxTraceEvents)
+        self.origin = time.perf_counter()
+        self.run = 0
+
+    def startRun(self):
+        self.run += 1
+
+    def _event(self, name, cat, start, duration, args=None):
+        self.events.append({'name': name, 'cat': cat, 'ph': 'X',
+                            'ts': (start - self.origin) * 1e6,
+                            'dur': duration * 1e6, 'pid': 0, 'tid': 0,
+                            'args': args or {}})
+
+    def addChunk(self, name, stats):
+        if 'start' not in stats:
+            return
+
+        start = stats['start']
+        args = {k: v for k, v in stats.items() if k != 'start'}
+        self._event(name, 'chunk', start, stats['wall'],
+                    dict(args, run=self.run))
+        self._event('compile', 'compile', start, stats['compile'])
+        if stats.get('copy'):
+            self._event('copy', 'copy', start + stats['compile'],
+                        stats['copy'])
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': list(self.events),
+                       'displayTimeUnit': 'ms'}, f)
+
+
+def formatReport(views, lines):
+    # the report of the TshunkyPyProfile command: the executed chunks ranked
+    # by their wall time. lines are the lines of the buffer
+    def ms(s):
+        return '-' if s is None else f'{s * 1000:.1f}'
+
+    def kb(b):
+        return '-' if b is None else f'{b / 1024:.1f}'
+
+    profiled = sorted((v for v in views if v.stats),
+                      key=lambda v: v.stats['wall'], reverse=True)
+    total = sum(v.stats['wall'] for v in profiled)
+
+    header = f'{"line":>6} {"wall ms":>9} {"cpu ms":>9} {"copy ms":>9} ' + \
+             f'{"compile ms":>10} {"size KB":>9} {"peak KB":>9}  chunk'
+    report = ['TshunkyPy.profile:',
+              '------------------',
+              f'{len(profiled)} chunks, {ms(total)} ms in total',
+              '',
+              header]
+
+    for v in profiled:
+        s = v.stats
+        start = v.lineRange.start
+        source = lines[start - 1].strip() if start <= len(lines) else ''
+        report.append(f'{start:>6} {ms(s["wall"]):>9} {ms(s.get("cpu")):>9} '
+                      f'{ms(s.get("copy")):>9} {ms(s.get("compile")):>10} '
+                      f'{kb(s.get("size")):>9} {kb(s.get("peak")):>9}  '
+                      f'{source[:60]}')
+
+    # where the copy time of the snapshots goes (-> copyStrategies)
+    copyTypes = {}
+    for v in profiled:
+        for name, (count, seconds) in v.stats.get('copyTypes', {}).items():
+            c, s = copyTypes.get(name, (0, 0))
+            copyTypes[name] = (c + count, s + seconds)
+
+    if copyTypes:
+        report += ['', f'{"copies":>8} {"copy ms":>9}  type']
+        for name, (count, seconds) in sorted(copyTypes.items(),
+                                             key=lambda i: i[1][1],
+                                             reverse=True):
+            report.append(f'{count:>8} {ms(seconds):>9}  {name}')
+    return report
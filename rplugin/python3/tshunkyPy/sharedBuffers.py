@@ -0,0 +1,34 @@
+import sys
+
+# smaller buffers are just copied
+_minSharedSize = 1024 * 1024
+
+
+def sharedCopy(value):
+    """Returns a copy of value that shares the memory of value without being
+    able to mutate it, None if value is no such object
+
+    These are read-only views of (big) numpy arrays and shallow copies of
+    pandas objects if pandas' copy_on_write mode is enabled. Writing to a
+    view raises a ValueError ('... read-only').
+    """
+    np = sys.modules.get('numpy')
+    if np and isinstance(value, np.ndarray):
+        # the objects of object arrays would be shared as well
+        if value.nbytes < _minSharedSize or value.dtype.hasobject:
+            return None
+        view = value.view()
+        view.flags.writeable = False
+        return view
+
+    pd = sys.modules.get('pandas')
+    if pd and isinstance(value, (pd.DataFrame, pd.Series)):
+        if getattr(pd.options.mode, 'copy_on_write', False) is True:
+            return value.copy(deep=False)
+
+    return None
+
+
+def isReadOnlyError(e):
+    # whether the exception e was raised by writing to a read-only view
+    return isinstance(e, ValueError) and 'read-only' in str(e)
@@ -0,0 +1,257 @@
+from .diskCache import dumpState, loadState
+from .config import config
+
+import os
+import sys
+import mmap
+import zlib
+import types
+import logging
+import tempfile
+import itertools
+from collections import OrderedDict, deque
+
+# snapshots smaller than this are not worth evicting
+_minSnapshotSize = 16 * 1024
+# (roughly) how fast snapshots get pickled and compressed (bytes / second),
+# snapshots that are cheaper to recompute than that are dropped right away
+_serializeThroughput = 100 * 1024 * 1024
+# the number of items of a container estimateSize looks at
+_sampleSize = 100
+# buffers that are bigger are stored out-of-band (-> SnapshotStore._compress)
+_minOutOfBandSize = 1024 * 1024
+
+
+def estimateSize(value, depth=3):
+    """A cheap estimation of the memory held by value, big containers are
+    sampled"""
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        # numpy arrays, memoryviews,... views (-> sharedCopy) and memory
+        # mapped ones don't own their memory
+        if getattr(value, 'base', None) is not None:
+            return sys.getsizeof(value, 0)
+        return max(nbytes, sys.getsizeof(value, 0))
+
+    size = sys.getsizeof(value, 0)
+    if depth == 0 or isinstance(value, (type, types.ModuleType,
+                                        types.FunctionType)):
+        return size
+
+    if isinstance(value, dict):
+        items = list(itertools.islice(value.items(), _sampleSize))
+        sample = sum(estimateSize(k, depth-1) + estimateSize(v, depth-1)
+                        for k, v in items)
+    elif isinstance(value, (list, tuple, set, frozenset, deque)):
+        items = list(itertools.islice(value, _sampleSize))
+        sample = sum(estimateSize(v, depth-1) for v in items)
+    elif isinstance(getattr(value, '__dict__', None), dict):
+        return size + estimateSize(value.__dict__, depth-1)
+    else:
+        return size
+
+    if items:
+        size += sample * len(value) // len(items)
+    return size
+
+
+class SnapshotStore:
+    """Keeps the snapshots (namespace and delta) of the chunks of the copy
+    snapshotEngine within config.snapshotMemory MB
+
+    Beyond it the snapshots that are the cheapest to recompute compared to
+    their size are evicted: they get compressed in memory and spilled to disk
+    if that's not enough (config.snapshotSpill). Big buffers are written to
+    disk right away and memory mapped (copy on write) when they are loaded.
+    Snapshots that can't be pickled (or are cheaper to recompute than to
+    pickle) are dropped and rebuilt by executing the chunk again. Evicted
+    snapshots are restored when they are needed (-> materialize), from the
+    closest resident ancestor.
+    """
+    def __init__(self):
+        # chunk -> estimated size of its snapshot (in bytes)
+        self.resident = OrderedDict()
+        # chunk -> (compressed delta / path of the spilled one, out-of-band
+        # buffers (path, [(offset, size), ...]) or None)
+        self.compressed = OrderedDict()
+        self.spilled = {}
+        self.dropped = set()
+
+        self.spillDir = None
+        self.spillIds = itertools.count()
+
+    def evicted(self, chunk):
+        return chunk in self.compressed or chunk in self.spilled or \
+               chunk in self.dropped
+
+    def add(self, chunk, evict=True):
+        # (re)registers the current snapshot of chunk
+        self.forget(chunk)
+        self.resident[chunk] = estimateSize(chunk.delta)
+        if evict:
+            self._evict({chunk})
+
+    def track(self, chunk):
+        # registers chunks whose snapshot was created by rebasing
+        if chunk not in self.resident:
+            self.add(chunk)
+
+    def forget(self, chunk):
+        self.resident.pop(chunk, None)
+        self.dropped.discard(chunk)
+        if chunk in self.compressed:
+            _, buffers = self.compressed.pop(chunk)
+            self._remove(buffers)
+        if chunk in self.spilled:
+            path, buffers = self.spilled.pop(chunk)
+            self._remove(buffers, path)
+
+    def materialize(self, chunk):
+        # makes sure the namespace of chunk exists, returns False if it could
+        # not be rebuilt (the chunk is invalid afterwards)
+        keep = {chunk}
+        chain = []
+        while chunk.namespace is None and chunk.prevChunk:
+            chain.append(chunk)
+            chunk = chunk.prevChunk
+
+        for c in reversed(chain):
+            if c in self.compressed:
+                c.delta = self._load(*self.compressed[c], c)
+                c.deriveNamespace()
+            elif c in self.spilled:
+                path, buffers = self.spilled[c]
+                with open(path, 'rb') as f:
+                    c.delta = self._load(f.read(), buffers, c)
+                c.deriveNamespace()
+            elif c in self.dropped:
+                logging.debug('replaying %s', c.getDebugId())
+                if not c.replay():
+                    logging.warning('tshunkyPy: replaying %s failed',
+                                    c.getDebugId())
+                    return False
+            else:
+                # released or restored from the DiskCache
+                c.deriveNamespace()
+            self.add(c, evict=False)
+
+        self._evict(keep)
+        return True
+
+    def _load(self, data, buffers, chunk):
+        views = []
+        if buffers:
+            # the pages are copied when they are written to
+            path, layout = buffers
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            views = [memoryview(mapped)[o:o+n] for o, n in layout]
+        return loadState(zlib.decompress(data), chunk.globalState,
+                         buffers=views)
+
+    def _cost(self, chunk):
+        # what it costs to recompute the snapshot
+        return chunk.stats.get('wall', 0)
+
+    def _evict(self, keep):
+        budget = config.snapshotMemory * 1024 * 1024
+        used = sum(self.resident.values()) + \
+               sum(len(d) for d, _ in self.compressed.values())
+        if used <= budget:
+            return
+
+        # the namespaces share the values of the evicted snapshots, they would
+        # keep them alive. They are cheap to derive again (-> materialize)
+        for c in self.resident:
+            if c not in keep:
+                c.namespace = None
+
+        # the snapshots that are cheap to recompute but big come first
+        candidates = sorted((c for c, size in self.resident.items()
+                                if c not in keep and size >= _minSnapshotSize),
+                            key=lambda c: self._cost(c) / self.resident[c])
+        for chunk in candidates:
+            if used <= budget:
+                break
+            size = self.resident.pop(chunk)
+            used -= size
+
+            entry = None
+            if self._cost(chunk) >= size / _serializeThroughput:
+                entry = self._compress(chunk)
+            if entry is None:
+                self.dropped.add(chunk)
+            else:
+                self.compressed[chunk] = entry
+                used += len(entry[0])
+            chunk.namespace, chunk.delta = None, None
+            logging.debug('evicted %s', chunk.getDebugId())
+
+        # the least recently compressed ones go next
+        while used > budget and self.compressed:
+            chunk, (data, buffers) = self.compressed.popitem(last=False)
+            used -= len(data)
+            if config.snapshotSpill:
+                path = self._spillPath()
+                with open(path, 'wb') as f:
+                    f.write(data)
+                self.spilled[chunk] = (path, buffers)
+            else:
+                self._remove(buffers)
+                self.dropped.add(chunk)
+
+    def _compress(self, chunk):
+        # big buffers (numpy arrays,...) are not pickled, but written to disk
+        # as they are (pickle protocol 5 out-of-band buffers, only if
+        # config.snapshotSpill allows to use the disk)
+        buffers = []
+        def outOfBand(buf):
+            try:
+                size = buf.raw().nbytes
+            except BufferError:
+                # not contiguous
+                return True
+            if not config.snapshotSpill or size < _minOutOfBandSize:
+                return True
+            buffers.append(buf)
+            return False
+
+        try:
+            data = dumpState(chunk.delta, chunk.globalState, protocol=5,
+                             buffer_callback=outOfBand)
+        except Exception:
+            logging.debug('%s is not picklable', chunk.getDebugId())
+            return None
+
+        return zlib.compress(data, 1), self._writeBuffers(buffers)
+
+    def _writeBuffers(self, buffers):
+        if not buffers:
+            return None
+
+        path = self._spillPath()
+        layout = []
+        with open(path, 'wb') as f:
+            for buf in buffers:
+                # keep them aligned
+                f.write(b'\0' * (-f.tell() % 64))
+                raw = buf.raw()
+                layout.append((f.tell(), raw.nbytes))
+                f.write(raw)
+        return path, layout
+
+    def _remove(self, buffers, path=None):
+        # the files of the out-of-band buffers and the spilled delta
+        for p in (buffers and buffers[0], path):
+            if not p:
+                continue
+            try:
+                os.remove(p)
+            except OSError:
+                # still mapped (windows)
+                pass
+
+    def _spillPath(self):
+        if not self.spillDir:
+            self.spillDir = tempfile.TemporaryDirectory(prefix='tshunkyPy')
+        return os.path.join(self.spillDir.name, str(next(self.spillIds)))
@@ -0,0 +1,221 @@
+"""Benchmarks the ChunkManager with synthetic sources, without nvim
+
+    cd rplugin/python3
+    python -m tshunkyPy.test.bench [--scenario tinyChunks ...] [--repeat 3]
+                                   [--engine copy|fork] [--output out.json]
+                                   [--snapshot-memory MB]
+
+Each scenario is parsed and executed cold and afterwards a line at the top,
+the middle and the bottom of the source gets edited. The latencies (median of
+the repeats), the number of executed chunks and -- in a separate pass with
+tracemalloc -- the memory of every phase are written as json.
+"""
+from ..chunkManager import ChunkManager
+from ..forkCheckpoints import CheckpointEngine
+from ..config import config
+from .. import chunk as chunkModule
+
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import tracemalloc
+
+
+class OutputManager:
+    # renders nothing, the benchmark is about the engine
+    def update(self, chunk):
+        pass
+
+    def delete(self, chunk):
+        pass
+
+    def setSyntaxError(self, e, lineRange=None):
+        if e:
+            raise e
+
+
+# the scenarios return the lines of their source. Each of them contains
+# editable lines ("name = <int>") all over the place (-> _edit)
+
+def tinyChunks(n=1000):
+    # lots of one line chunks, every 10th one starts a new dependency chain
+    return [f'c{i} = {i}' if i % 10 == 0 else f'c{i} = c{i-1} + 1'
+                for i in range(n)]
+
+def hugeChunks(n=4, size=500):
+    # a few chunks with hundreds of lines each
+    lines = []
+    for k in range(n):
+        lines.append(f'acc{k} = {k}')
+        lines.append('for i in range(100):')
+        lines.extend(f'    acc{k} += i * {j}' for j in range(size))
+        lines.append(f'def f{k}(x):')
+        lines.extend(f'    x = x + {j}' for j in range(size))
+        lines.append('    return x')
+        lines.append(f'r{k} = f{k}(acc{k})')
+    return lines
+
+def largeGlobals(n=20):
+    # big globals that are read or mutated by the following chunks
+    try:
+        import numpy
+        lines = ['import numpy as np', 'arr = np.zeros((1000, 1000))']
+    except ImportError:
+        lines = ['arr = bytearray(8 * 1000 * 1000)']
+
+    lines.append('d = {i: str(i) for i in range(100000)}')
+    for i in range(n):
+        lines.append(f'k{i} = {i}')
+        if i % 2:
+            lines.append(f's{i} = len(arr) + len(d) + k{i}')
+        else:
+            lines.append(f'arr[{i}] = k{i}')
+            lines.append(f'd[{i}] = k{i}')
+    return lines
+
+def exprLoops(n=10, iterations=2000):
+    # expression statements in (nested) loops (-> printExpr)
+    lines = []
+    for k in range(n):
+        lines.append(f'n{k} = {iterations}')
+        lines.append(f'for i in range(n{k}):')
+        lines.append('    i * 2')
+        lines.append('    for j in range(5):')
+        lines.append('        i + j')
+    return lines
+
+scenarios = {f.__name__: f for f in (tinyChunks, hugeChunks, largeGlobals,
+                                     exprLoops)}
+
+_editable = re.compile(r'^(\w+) = (\d+)$')
+
+def _edit(lines, position):
+    # changes the value of the editable line closest to position
+    # (0 -> top, 1 -> bottom) and returns its index
+    target = round(position * (len(lines) - 1))
+    candidates = [i for i, l in enumerate(lines) if _editable.match(l)]
+    i = min(candidates, key=lambda i: abs(i - target))
+    name, value = _editable.match(lines[i]).groups()
+    lines[i] = f'{name} = {int(value) + 1}'
+    return i
+
+
+def _phases(lines, engine):
+    # runs all phases of a scenario once, yields (phase, update time,
+    # execute time, executed chunks)
+    chunkModule._codeCache.clear()
+    checkpoints = CheckpointEngine() if engine == 'fork' else None
+    chunkManager = ChunkManager(OutputManager(), checkpoints)
+    filename = '<bench>'
+    lines = list(lines)
+
+    def measure(execute, dirty=None):
+        start = time.perf_counter()
+        chunkManager.update('\n'.join(lines), filename, dirty)
+        updated = time.perf_counter()
+        execute()
+        done = time.perf_counter()
+        executed = sum(1 for c in chunkManager.chunks.values()
+                             if c.stats.get('start', 0) >= updated)
+        return updated - start, done - updated, executed
+
+    try:
+        yield ('cold',) + measure(chunkManager.executeAllChunks)
+        yield ('noop',) + measure(chunkManager.executeAllInvalidChunks)
+        for name, position in (('editTop', 0), ('editMiddle', 0.5),
+                               ('editBottom', 1)):
+            i = _edit(lines, position)
+            yield (name,) + measure(chunkManager.executeAllInvalidChunks,
+                                    (i, i + 1, i + 1))
+    finally:
+        if checkpoints:
+            checkpoints.quit()
+
+
+def runScenario(name, repeat, engine, memory=True):
+    lines = scenarios[name]()
+    timings = {}
+
+    for _ in range(repeat):
+        for phase, update, execute, executed in _phases(lines, engine):
+            timings.setdefault(phase, []).append((update, execute, executed))
+
+    phases = {}
+    for phase, runs in timings.items():
+        update = statistics.median(r[0] for r in runs)
+        execute = statistics.median(r[1] for r in runs)
+        executed = runs[-1][2]
+        latency = update + execute
+        phases[phase] = {
+            'latency': latency,
+            'minLatency': min(r[0] + r[1] for r in runs),
+            'update': update,
+            'execute': execute,
+            'executedChunks': executed,
+            'chunksPerSecond': executed / execute if execute else None,
+            'linesPerSecond': len(lines) / update if update else None,
+        }
+
+    if memory:
+        # the memory is measured separately, tracing distorts the timings
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        for phase, *_ in _phases(lines, engine):
+            current, peak = tracemalloc.get_traced_memory()
+            phases[phase]['peakMemory'] = peak - baseline
+            phases[phase]['retainedMemory'] = current - baseline
+            tracemalloc.reset_peak()
+        tracemalloc.stop()
+
+    # all chunks are executed by the cold run
+    return {'lines': len(lines), 'chunks': phases['cold']['executedChunks'],
+            'phases': phases}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='benchmarks the tshunkyPy engine')
+    parser.add_argument('--scenario', action='append',
+                        choices=list(scenarios.keys()),
+                        help='the scenarios to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--engine', choices=['copy', 'fork'], default='copy')
+    parser.add_argument('--snapshot-memory', type=float, default=None,
+                        help='config.snapshotMemory (MB)')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the tracemalloc pass')
+    parser.add_argument('--output', help='the json file (default: stdout)')
+    args = parser.parse_args(argv)
+
+    # the chunks should neither time out nor spill anything to disk
+    config.update({'chunkTimeout': None, 'runTimeout': None,
+                   'diskCache': False, 'profileMemory': False,
+                   'snapshotMemory': args.snapshot_memory})
+
+    result = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'engine': args.engine,
+              'snapshotMemory': args.snapshot_memory,
+              'repeat': args.repeat,
+              'scenarios': {}}
+
+    for name in args.scenario or scenarios.keys():
+        result['scenarios'][name] = runScenario(name, args.repeat,
+                                                args.engine, args.memory)
+        for phase, p in result['scenarios'][name]['phases'].items():
+            print(f'{name:>14} {phase:>10}: {p["latency"] * 1000:9.1f} ms '
+                  f'({p["executedChunks"]} chunks)', file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,13 +13,13 @@ class OutputManager:
         if not chunk.vtexts:
             return
 
-        ts = [f'{file.name}:{lno} {t}' for lno, t in chunk.vtexts]
+        ts = [f'{file.name}:{lno} {t}' for lno, t in chunk.vtexts.items()]
         print('\n'.join(ts))
 
     def delete(self, chunk):
         pass
 
-    def setSyntaxError(self, e):
+    def setSyntaxError(self, e, lineRange=None):
         if e:
             print(repr(e))
 
@@ -0,0 +1,64 @@
+
+class BufferShadow:
+    """A copy of the lines of a buffer that is kept in sync by the
+    nvim_buf_lines_event notifications (-> nvim_buf_attach)
+
+    sync() returns the edits -- (firstline, lastline, lines) -- since the last
+    sync, lastline == -1 replaces all lines. If nothing changed it returns None.
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        self.lines = None
+        # None -> the next sync sends all lines
+        self.edits = None
+        self.attached = self.buf.api.attach(True, {})
+
+    def linesEvent(self, firstline, lastline, linedata):
+        if lastline == -1:
+            # the initial event (send_buffer) contains all lines
+            self.lines = linedata
+            self.edits = None
+            return
+
+        if self.lines is None:
+            return
+
+        self.lines[firstline:lastline] = linedata
+        if self.edits is not None:
+            self.edits.append((firstline, lastline, linedata))
+
+    @property
+    def dirty(self):
+        # whether the next sync returns any edits
+        return self.edits is None or bool(self.edits)
+
+    def detached(self):
+        self.attached = False
+        self.lines = None
+        self.edits = None
+
+    def resync(self):
+        self.edits = None
+
+    def sync(self):
+        if not self.attached:
+            self.attached = self.buf.api.attach(True, {})
+
+        if self.lines is None:
+            # no shadow (yet), the next sync needs to send all lines as well
+            return [(0, -1, self.buf[:])]
+
+        if self.edits is None:
+            edits = [(0, -1, list(self.lines))]
+        elif self.edits:
+            edits = self.edits
+        else:
+            return None
+
+        self.edits = []
+        return edits
+
+    def detach(self):
+        if self.attached:
+            self.buf.api.detach()
+        self.detached()
@@ -0,0 +1,31 @@
+import logging
+from collections import deque
+
+
+class JobQueue:
+    """Runs jobs one after another in the event loop of nvim
+
+    The handlers of pynvim run in greenlets, while a job waits for the
+    response of a request another handler might get called. Jobs submitted in
+    the meantime are queued and run by the handler that runs the queue
+    already (in submission order). Nobody waits or polls.
+    """
+    def __init__(self):
+        self.jobs = deque()
+        self.running = False
+
+    def submit(self, job, *args):
+        self.jobs.append((job, args))
+        if self.running:
+            return
+
+        self.running = True
+        try:
+            while self.jobs:
+                job, args = self.jobs.popleft()
+                try:
+                    job(*args)
+                except Exception:
+                    logging.exception('tshunkyPy: %s failed', job.__name__)
+        finally:
+            self.running = False
@@ -0,0 +1,51 @@
+from ..config import config
+
+import threading
+
+
+class LiveScheduler:
+    """Coalesces the live triggers of a buffer
+
+    A trigger doesn't run the live command right away, but after a delay
+    that adapts to the (measured) cost of the runs: config.liveDebounceFactor
+    times the average run time, at most config.liveDebounceMax seconds. All
+    triggers in the meantime are merged into one run.
+
+    If the buffer didn't change (shouldRun() is False) while the kernel is
+    busy, the run in flight is up to date already and the trigger is
+    dropped. Otherwise the kernel cancels the stale run.
+    """
+    def __init__(self, nvim, shouldRun):
+        self.nvim = nvim
+        self.shouldRun = shouldRun
+        self.command = None
+        self.timer = None
+        self.cost = 0.0
+
+    def trigger(self, command):
+        self.command = command
+        if self.timer:
+            return
+
+        delay = min(self.cost * config.liveDebounceFactor,
+                    config.liveDebounceMax)
+        self.timer = threading.Timer(delay, self.nvim.async_call,
+                                     (self._fire,))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _fire(self):
+        self.timer = None
+        command, self.command = self.command, None
+        if command and self.shouldRun():
+            self.nvim.command(command)
+
+    def measured(self, cost):
+        # moving average of the time the kernel was busy per run
+        self.cost = cost if not self.cost else 0.7 * self.cost + 0.3 * cost
+
+    def cancel(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.command = None
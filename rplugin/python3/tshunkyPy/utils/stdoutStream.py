@@ -0,0 +1,86 @@
+import io
+import time
+import itertools
+import threading
+from collections import deque
+
+
+class StdoutStream(io.TextIOBase):
+    """A replacement for sys.stdout that keeps the last maxLines lines only
+    (ring buffer)
+
+    While it gets written to, the lines written since the last flush and the
+    last (not yet terminated) line are passed to onFlush -- at most every
+    interval seconds. Output that got throttled is flushed by a timer, so the
+    last lines show up even if nothing gets written for a while.
+    """
+    def __init__(self, maxLines, onFlush=None, interval=0.2):
+        self.lines = deque(maxlen=maxLines)
+        # the last (not yet terminated) line
+        self.partial = ''
+        self.dropped = 0
+        # the number of lines written so far / till the last flush
+        self.written = 0
+        self.flushed = 0
+
+        self.onFlush = onFlush
+        self.interval = interval
+        self.lastFlush = 0
+        self.timer = None
+        self.lock = threading.Lock()
+        self.done = False
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        with self.lock:
+            lines = (self.partial + s).split('\n')
+            self.partial = lines.pop()
+            overflow = len(self.lines) + len(lines) - self.lines.maxlen
+            self.dropped += max(overflow, 0)
+            self.lines.extend(lines)
+            self.written += len(lines)
+
+            if self.onFlush and not self.timer:
+                wait = self.lastFlush + self.interval - time.monotonic()
+                if wait <= 0:
+                    self._flush()
+                else:
+                    self.timer = threading.Timer(wait, self._timedFlush)
+                    self.timer.daemon = True
+                    self.timer.start()
+        return len(s)
+
+    def _timedFlush(self):
+        with self.lock:
+            self.timer = None
+            if not self.done:
+                self._flush()
+
+    def _flush(self):
+        self.lastFlush = time.monotonic()
+        new = self.written - self.flushed
+        self.flushed = self.written
+        tail = list(itertools.islice(self.lines,
+                                     max(len(self.lines) - new, 0), None))
+        head = f'... ({new - len(tail)} lines dropped)\n' \
+                    if new > len(tail) else ''
+        self.onFlush(head + ''.join(l + '\n' for l in tail), self.partial)
+
+    def _value(self):
+        head = f'... ({self.dropped} lines dropped)\n' if self.dropped else ''
+        return head + ''.join(l + '\n' for l in self.lines) + self.partial
+
+    def getvalue(self):
+        with self.lock:
+            return self._value()
+
+    def finish(self):
+        # no flushes after this one returned
+        with self.lock:
+            self.done = True
+            timer = self.timer
+        if timer:
+            timer.cancel()
+            timer.join()
@@ -0,0 +1,51 @@
+from .config import config
+
+import logging
+import sysconfig
+import importlib
+from pathlib import Path
+
+
+# the directories the python installation and third party packages live in
+_installDirs = tuple({Path(p).resolve().as_posix() + '/' for p in
+                      (sysconfig.get_path(n) for n in
+                            ('stdlib', 'platstdlib', 'purelib', 'platlib'))
+                      if p})
+_stable = {}
+
+def _isInstalled(module):
+    spec = getattr(module, '__spec__', None)
+    origin = getattr(spec, 'origin', None) or getattr(module, '__file__', None)
+    if origin in (None, 'built-in', 'frozen'):
+        # namespace packages have no origin, but their search path
+        paths = list(getattr(module, '__path__', []))
+        if not paths:
+            return origin is not None
+        return all(Path(p).resolve().as_posix().startswith(_installDirs)
+                   for p in paths)
+
+    return Path(origin).resolve().as_posix().startswith(_installDirs)
+
+def isStableModule(name, module):
+    """Whether the module stays loaded once a chunk imported it and is shared
+    between chunks instead of being copied
+
+    These are the packages listed in config.stableModules and -- if
+    config.autoStableModules is set -- everything installed into the python
+    installation (stdlib, site-packages).
+    """
+    if name.partition('.')[0] in config.stableModules:
+        return True
+    if not config.autoStableModules:
+        return False
+
+    if name not in _stable:
+        _stable[name] = _isInstalled(module)
+    return _stable[name]
+
+def preImportModules():
+    for name in config.preImportModules:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            logging.warning('tshunkyPy: pre-importing %s failed', name)